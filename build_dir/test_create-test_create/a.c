@@ -0,0 +1 @@
+a.c
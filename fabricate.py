@@ -27,16 +27,24 @@ This version ONLY runs on Python 3.
 # fabricate version number
 __version__ = '3.00.1'
 
-# if version of .deps file has changed, we know to not use it
+# if version of .deps file has changed, we migrate it with deps_migrations
+# or, failing that, don't use it
 deps_version = 2
 
 import atexit
 import argparse
+import array
+import codecs
+import collections.abc
+import concurrent.futures
+import mmap
 import os
 import platform
 import re
 import shlex
+import shutil
 import stat
+import struct
 import subprocess
 import sys
 import tempfile
@@ -57,9 +65,11 @@ if (sys.version_info.major != PY_MAJOR_REQUIRED) or (sys.version_info.minor < PY
 # so you can do "from fabricate import *" to simplify your build script
 __all__ = ['setup', 'run', 'autoclean', 'main', 'shell', 'fabricate_version',
            'memoize', 'outofdate', 'parse_options', 'after',
-           'ExecutionError', 'md5_hasher', 'mtime_hasher',
+           'ExecutionError', 'md5_hasher', 'mtime_hasher', 'sha1_hasher',
+           'blake2b_hasher', 'blake2s_hasher', 'stat_hasher', 'tree_hasher',
+           'git_blob_hasher', 'git_hasher', 'GitHasher', 'hashers',
            'Runner', 'AtimesRunner', 'StraceRunner', 'AlwaysRunner',
-           'SmartRunner', 'Builder']
+           'SmartRunner', 'Builder', 'HashCache']
 
 import textwrap
 
@@ -106,6 +116,40 @@ except ImportError:
                 return cPickle.dump(obj, f)
         json = PickleJson()
 
+# size of the buffer used to read files when hashing them
+hash_buffer_size = 256*1024
+
+def file_digest(f, hashfunc):
+    """ Return a hash object created by hashfunc and updated with the
+        contents of the binary file object f. The file is read in chunks
+        of hash_buffer_size so memory use doesn't grow with file size. """
+    if hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(f, hashfunc)
+    return update_hash(hashfunc(), f)
+
+def update_hash(hash, f):
+    """ Update hash object hash with the rest of the contents of the binary
+        file object f, read in chunks of hash_buffer_size, and return it. """
+    buffer = bytearray(hash_buffer_size)
+    view = memoryview(buffer)
+    while True:
+        size = f.readinto(buffer)
+        if not size:
+            break
+        hash.update(view[:size])
+    return hash
+
+# sqlite3 is optional, it's only needed for the shared hash cache
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # dependency files aren't locked on Windows
+
 def printerr(message):
     """ Print given message to stderr with a line feed. """
     print(message, file=sys.stderr)
@@ -199,6 +243,29 @@ def _shell(args, input=None, silent=True, shell=False, ignore_status=False, **kw
     if silent:
         return output
 
+def hash_file(filename, hashfunc):
+    """ Return the hex digest given by hashfunc (a hashlib constructor) of
+        filename as described for md5_hasher(), or None if file doesn't
+        exist. """
+    if not isinstance(filename, bytes):
+        filename = filename.encode('utf-8')
+    try:
+        f = open(filename, 'rb')
+        try:
+            return file_digest(f, hashfunc).hexdigest()
+        finally:
+            f.close()
+    except IOError:
+        if hasattr(os, 'readlink') and os.path.islink(filename):
+            hash = hashfunc()
+            hash.update(os.readlink(filename))
+            return hash.hexdigest()
+        elif os.path.isdir(filename):
+            hash = hashfunc()
+            hash.update(filename)
+            return hash.hexdigest()
+        return None
+
 def md5_hasher(filename):
     """ Return MD5 hash of given filename if it is a regular file or
         a symlink with a hashable target, or the MD5 hash of the
@@ -210,29 +277,340 @@ def md5_hasher(filename):
         Windows so symlinks without a hashable target fall back to
         a hash of the filename if the symlink target is a directory,
         or None if the symlink is broken"""
-    if not isinstance(filename, bytes):
-        filename = filename.encode('utf-8')
-    try:
-        f = open(filename, 'rb')
-        try:
-            return md5func(f.read()).hexdigest()
-        finally:
-            f.close()
-    except IOError:
-        if hasattr(os, 'readlink') and os.path.islink(filename):
-            return md5func(os.readlink(filename)).hexdigest()
-        elif os.path.isdir(filename):
-            return md5func(filename).hexdigest()
+    return hash_file(filename, md5func)
+
+def _tag(name, hashed):
+    """ Return hashed tagged with the name of the hasher that produced it,
+        or None if hashed is None. """
+    if hashed is None:
         return None
+    return name + ':' + hashed
+
+def sha1_hasher(filename):
+    """ Return "sha1:" and the SHA-1 hash of filename as per md5_hasher(). """
+    return _tag('sha1', hash_file(filename, hashlib.sha1))
+
+def _blake2b16():
+    return hashlib.blake2b(digest_size=16)
+
+def _blake2s16():
+    return hashlib.blake2s(digest_size=16)
+
+def blake2b_hasher(filename):
+    """ Return "blake2b:" and the 128-bit BLAKE2b hash of filename as per
+        md5_hasher(). BLAKE2b is faster than MD5 on 64-bit machines. """
+    return _tag('blake2b', hash_file(filename, _blake2b16))
+
+def blake2s_hasher(filename):
+    """ Return "blake2s:" and the 128-bit BLAKE2s hash of filename as per
+        md5_hasher(). BLAKE2s is faster than MD5 on 32-bit machines. """
+    return _tag('blake2s', hash_file(filename, _blake2s16))
 
 def mtime_hasher(filename):
-    """ Return modification time of file, or None if file doesn't exist. """
+    """ Return "mtime:" and the modification time of file in nanoseconds,
+        or None if file doesn't exist. """
     try:
         st = os.stat(filename)
-        return repr(st.st_mtime)
+        return _tag('mtime', str(st.st_mtime_ns))
     except (IOError, OSError):
         return None
 
+# files changed less than this many seconds ago may change again without
+# their stat fingerprint changing, so their hashes aren't reused by stat_cache
+stat_racy_time = 2
+
+def stat_fingerprint(st):
+    """ Return the stat fingerprint of an os.stat() result as a list of
+        [size, mtime_ns, ctime_ns, inode, device]. A file whose fingerprint
+        hasn't changed is assumed to have unchanged contents. """
+    return [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino, st.st_dev]
+
+def stat_hasher(filename):
+    """ Return "stat:" and the stat fingerprint of filename (or of the
+        symlink itself if it is broken), or None if file doesn't exist.
+        This never reads file contents. """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        try:
+            st = os.lstat(filename)
+        except OSError:
+            return None
+    return _tag('stat', '-'.join(str(n) for n in stat_fingerprint(st)))
+
+# files at least this big are hashed in chunks on several threads by
+# tree_hasher, which has a shared pool of tree_hash_jobs threads
+tree_hash_threshold = 64*1024*1024
+tree_hash_chunk_size = 4*1024*1024
+tree_hash_jobs = os.cpu_count() or 1
+_tree_pool = None
+_tree_pool_lock = threading.Lock()
+
+def _hash_chunk(fd, offset):
+    """ Return the MD5 digest of the tree_hash_chunk_size bytes of open
+        file descriptor fd at offset. """
+    return md5func(os.pread(fd, tree_hash_chunk_size, offset)).digest()
+
+def tree_hasher(filename):
+    """ Return md5_hasher(filename) for files smaller than
+        tree_hash_threshold. Larger regular files are split into
+        tree_hash_chunk_size chunks which are hashed in parallel, and
+        "md5tree:" and the MD5 of the chunk digests (the root of a one level
+        Merkle tree) is returned. """
+    global _tree_pool
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return md5_hasher(filename)
+    if not stat.S_ISREG(st.st_mode) or st.st_size < tree_hash_threshold:
+        return md5_hasher(filename)
+    with _tree_pool_lock:
+        if _tree_pool is None:
+            _tree_pool = concurrent.futures.ThreadPoolExecutor(tree_hash_jobs)
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return md5_hasher(filename)
+    try:
+        chunks = [_tree_pool.submit(_hash_chunk, fd, offset) for offset
+                  in range(0, st.st_size, tree_hash_chunk_size)]
+        root = md5func()
+        for chunk in chunks:
+            root.update(chunk.result())
+    finally:
+        os.close(fd)
+    return _tag('md5tree', root.hexdigest())
+
+def user_cache_dir():
+    """ Return the directory for fabricate's per-user caches,
+        $XDG_CACHE_HOME/fabricate or ~/.cache/fabricate. """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+                 os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'fabricate')
+
+class HashCache(object):
+    """ Persistent cache of file hashes shared by every build directory of
+        a user, so the same toolchain and library files are only hashed
+        once however many worktrees use them. Hashes are keyed by the
+        file's device, inode, size, mtime and ctime and by hasher name.
+
+        The cache is an SQLite database in WAL mode, so concurrent builds
+        can share it. New hashes are written in one transaction by flush(),
+        which also evicts the least recently used hashes once there are
+        more than max_entries. """
+
+    def __init__(self, filename=None, max_entries=1000000):
+        if sqlite3 is None:
+            raise ImportError('HashCache requires the sqlite3 module')
+        if filename is None:
+            filename = os.path.join(user_cache_dir(), 'hashes.sqlite')
+        directory = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.filename = filename
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._new = {}      # key: hash, for hashes not yet flushed
+        self._used = set()  # keys of hashes read from the database
+        self._db = sqlite3.connect(filename, timeout=60,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                         'device INTEGER, inode INTEGER, size INTEGER, '
+                         'mtime_ns INTEGER, ctime_ns INTEGER, hasher TEXT, '
+                         'hash TEXT NOT NULL, used REAL NOT NULL, '
+                         'PRIMARY KEY (device, inode, size, mtime_ns, '
+                         'ctime_ns, hasher))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS hashes_used '
+                         'ON hashes (used)')
+
+    @staticmethod
+    def _key(st, hasher_name):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                st.st_ctime_ns, hasher_name)
+
+    def get(self, st, hasher_name):
+        """ Return the hash cached for the file with os.stat() result st,
+            or None if it isn't cached. """
+        key = self._key(st, hasher_name)
+        with self._lock:
+            if key in self._new:
+                return self._new[key]
+            row = self._db.execute(
+                'SELECT hash FROM hashes WHERE device=? AND inode=? AND '
+                'size=? AND mtime_ns=? AND ctime_ns=? AND hasher=?',
+                key).fetchone()
+            if row is None:
+                return None
+            self._used.add(key)
+            return row[0]
+
+    def put(self, st, hasher_name, hashed):
+        """ Cache hashed as the hash of the file with os.stat() result st. """
+        with self._lock:
+            self._new[self._key(st, hasher_name)] = hashed
+
+    def flush(self):
+        """ Write new hashes to the database, mark those read as recently
+            used and evict the least recently used over max_entries. """
+        with self._lock:
+            now = time.time()
+            with self._db:
+                self._db.execute('BEGIN IMMEDIATE')
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?,?,?)',
+                    [key + (hashed, now) for key, hashed in self._new.items()])
+                self._db.executemany(
+                    'UPDATE hashes SET used=? WHERE device=? AND inode=? '
+                    'AND size=? AND mtime_ns=? AND ctime_ns=? AND hasher=?',
+                    [(now,) + key for key in self._used])
+                count = self._db.execute(
+                    'SELECT COUNT(*) FROM hashes').fetchone()[0]
+                if count > self.max_entries:
+                    # evict down to 90% so this isn't done on every flush
+                    self._db.execute(
+                        'DELETE FROM hashes WHERE rowid IN (SELECT rowid '
+                        'FROM hashes ORDER BY used LIMIT ?)',
+                        (count - self.max_entries * 9 // 10,))
+            self._new = {}
+            self._used = set()
+
+def git_blob_hasher(filename):
+    """ Return "git:" and the git blob id (the SHA-1 of "blob <size>\\0"
+        and the contents) of filename if it is a regular file or symlink,
+        md5_hasher(filename) if it is a directory, or None if it doesn't
+        exist. """
+    try:
+        st = os.lstat(filename)
+    except OSError:
+        return None
+    hash = hashlib.sha1()
+    if stat.S_ISLNK(st.st_mode):
+        target = os.readlink(filename).encode('utf-8', 'surrogateescape')
+        hash.update(b'blob %d\0' % len(target))
+        hash.update(target)
+    elif stat.S_ISREG(st.st_mode):
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            hash.update(b'blob %d\0' % os.fstat(f.fileno()).st_size)
+            update_hash(hash, f)
+        finally:
+            f.close()
+    else:
+        return md5_hasher(filename)
+    return _tag('git', hash.hexdigest())
+
+class GitHasher(object):
+    """ Hasher giving the same hashes as git_blob_hasher, but taking the
+        blob ids of files that "git status" reports unchanged from the git
+        index instead of reading them. Only dirty, untracked or recently
+        modified files (and files outside the work tree) are read.
+
+        The index is loaded on the first call, from the git work tree
+        containing the current directory. Without git or a work tree every
+        file is hashed by git_blob_hasher. """
+
+    __name__ = 'git'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._top = None
+        self._blobs = None
+        self._loaded = 0
+
+    def _git(self, *args):
+        return subprocess.check_output(('git',) + args,
+                                       stderr=subprocess.DEVNULL)
+
+    def load(self):
+        """ (Re)load blob ids of clean tracked files from the git index. """
+        self._loaded = time.time()
+        self._blobs = {}
+        try:
+            top = self._git('rev-parse', '--show-toplevel')
+            entries = self._git('-C', top.rstrip(b'\n'),
+                                'ls-files', '--stage', '-z')
+            status = self._git('-C', top.rstrip(b'\n'), 'status',
+                               '--porcelain', '-z', '--untracked-files=no')
+        except (OSError, subprocess.CalledProcessError):
+            return
+        self._top = os.fsdecode(top.rstrip(b'\n'))
+        dirty = set()
+        records = iter(status.split(b'\0'))
+        for record in records:
+            if not record:
+                continue
+            if record[1:2] != b' ':
+                dirty.add(record[3:])
+            if record[:1] in (b'R', b'C'):
+                next(records, None)     # skip the rename/copy source
+        for entry in entries.split(b'\0'):
+            info, sep, path = entry.partition(b'\t')
+            if not sep or path in dirty:
+                continue
+            mode, blob, stage = info.split(b' ')
+            if stage == b'0' and mode != b'160000':   # not submodules
+                self._blobs[os.fsdecode(path)] = 'git:' + blob.decode()
+
+    def __call__(self, filename):
+        with self._lock:
+            if self._blobs is None:
+                self.load()
+        if self._top is not None:
+            path = os.path.relpath(os.path.abspath(filename), self._top)
+            blob = self._blobs.get(path)
+            if blob is not None:
+                try:
+                    st = os.lstat(filename)
+                except OSError:
+                    return None
+                # trust the index unless the file changed since we asked git
+                changed = max(st.st_mtime_ns, st.st_ctime_ns) / 1e9
+                if changed < self._loaded - stat_racy_time:
+                    return blob
+        return git_blob_hasher(filename)
+
+git_hasher = GitHasher()
+
+# hashers that can be selected by name with Builder(hasher=name). Each
+# hasher but md5 tags its hashes with its name, so a .deps file records
+# which hasher produced each hash (untagged 32-digit hashes are MD5 for
+# compatibility with older .deps files)
+hashers = {
+    'md5': md5_hasher,
+    'sha1': sha1_hasher,
+    'mtime': mtime_hasher,
+    'stat': stat_hasher,
+    'md5tree': tree_hasher,
+    'git': git_hasher,
+}
+if hasattr(hashlib, 'blake2b'):
+    hashers['blake2b'] = blake2b_hasher
+    hashers['blake2s'] = blake2s_hasher
+
+_md5_re = re.compile(r'[0-9a-f]{32}$')
+
+def hash_algorithm(hashed):
+    """ Return the name of the hasher in "hashers" that produced the hash
+        string hashed, or None if it isn't known. """
+    name, sep, digest = hashed.partition(':')
+    if sep:
+        return name if name in hashers else None
+    return 'md5' if _md5_re.match(hashed) else None
+
+def _hasher_name(hasher):
+    """ Return a name identifying the given hasher in the .deps file and
+        in the HashCache: its name in "hashers" if it has one. """
+    for name, named_hasher in hashers.items():
+        if hasher is named_hasher:
+            return name
+    return getattr(hasher, '__name__', type(hasher).__name__)
+
 class RunnerUnsupportedException(Exception):
     """ Exception raise by Runner constructor if it is not supported
         on the current platform."""
@@ -490,6 +868,49 @@ class StraceProcess(object):
         return '<StraceProcess cwd=%s deps=%s outputs=%s>' % \
                (self.cwd, self.deps, self.outputs)
 
+def _strace_string(args, start=0):
+    """ Return the first quoted string in the strace system call arguments
+        args from index start, as bytes with strace's escapes decoded, and
+        the index after it. Return (None, start) if there isn't one. """
+    begin = args.find(b'"', start)
+    if begin < 0:
+        return None, start
+    end = begin
+    while True:
+        end = args.find(b'"', end + 1)
+        if end < 0:
+            return None, start
+        # the quote is escaped if it follows an odd number of backslashes
+        backslash = end - 1
+        while args[backslash] == ord('\\'):
+            backslash -= 1
+        if (end - backslash) % 2:
+            break
+    value = args[begin + 1:end]
+    if b'\\' in value:
+        value = codecs.escape_decode(value)[0]
+    return value, end + 1
+
+def _strace_at_path(args, start=0):
+    """ Return the path argument of an *at system call that follows its
+        directory fd argument at index start of args, as per
+        _strace_string(). A relative path can only be resolved if the fd is
+        AT_FDCWD, so otherwise None is returned for it. """
+    comma = args.find(b',', start)
+    if comma < 0:
+        return None, start
+    name, end = _strace_string(args, comma + 1)
+    if (name and not name.startswith(b'/') and
+            args[start:comma].strip() != b'AT_FDCWD'):
+        return None, end
+    return name, end
+
+def _strace_result(args):
+    """ Return the result of a system call from its strace arguments and
+        result args, such as b'0' or b'-1', or b'' if it has none. """
+    call_args, sep, result = args.rpartition(b') = ')
+    return result.split(b' ', 1)[0] if sep else b''
+
 def _call_strace(self, *args, **kwargs):
     """ Top level function call for Strace that can be run in parallel """
     return self(*args, **kwargs)
@@ -502,208 +923,395 @@ class StraceRunner(Runner):
         self.strace_system_calls = StraceRunner.get_strace_system_calls()
         if self.strace_system_calls is None:
             raise RunnerUnsupportedException('strace is not available')
+        self.strace_options = []
+        if self.use_options:
+            self.strace_options = StraceRunner.get_strace_options()
         self.temp_count = 0
         self.build_dir = os.path.abspath(build_dir or os.getcwd())
+        self._path_names = {}
+        self._path_settings = None
+
+    # system calls traced if this system's strace supports them
+    possible_system_calls = ['open','openat', 'stat', 'stat64', 'lstat', 'lstat64',
+        'execve','exit_group','chdir','mkdir','rename','clone','vfork',
+        'fork','symlink','creat', 'openat2', 'newfstatat', 'statx', 'mkdirat',
+        'renameat', 'renameat2', 'symlinkat', 'clone3']
+
+    # strace options that cut tracing overhead without changing its output,
+    # used if this system's strace supports them and use_options is True:
+    # --seccomp-bpf stops the tracee only for the traced system calls
+    possible_options = ['--seccomp-bpf']
+    use_options = True
+
+    # probe results by strace binary, so each process probes at most once
+    _probed_system_calls = {}
+
+    _invalid_call_re = re.compile(r"invalid system call '([^']*)'")
 
     @staticmethod
     def get_strace_system_calls():
         """ Return None if this system doesn't have strace, otherwise
-            return a comma seperated list of system calls supported by strace. """
+            return a comma seperated list of system calls supported by strace.
+            Probe results are cached in user_cache_dir(), keyed by the
+            path, inode, size and modification time of strace. """
+        probe = StraceRunner._strace_probe()
+        return probe['calls'] if probe is not None else None
+
+    @staticmethod
+    def get_strace_options():
+        """ Return the list of possible_options the installed strace
+            accepts, probed and cached along with its system calls. """
+        probe = StraceRunner._strace_probe()
+        return probe['options'] if probe is not None else []
+
+    @staticmethod
+    def _strace_probe():
+        """ Return None if this system doesn't have strace, otherwise a
+            dict of its supported 'calls', 'options' and 'version', from
+            this process's probes, user_cache_dir() or a fresh probe. """
         if platform.system() == 'Windows':
             # even if windows has strace, it's probably a dodgy cygwin one
             return None
-        possible_system_calls = ['open','openat', 'stat', 'stat64', 'lstat', 'lstat64',
-            'execve','exit_group','chdir','mkdir','rename','clone','vfork',
-            'fork','symlink','creat']
-        valid_system_calls = []
+        strace = shutil.which('strace')
+        if strace is None:
+            return None
         try:
-            # check strace is installed and if it supports each type of call
-            for system_call in possible_system_calls:
-                proc = subprocess.Popen(['strace', '-e', 'trace=' + system_call], stderr=subprocess.PIPE)
-                stdout, stderr = proc.communicate()
-                proc.wait()
-                if b'invalid system call' not in stderr:
-                   valid_system_calls.append(system_call)
+            st = os.stat(strace)
         except OSError:
             return None
-        return ','.join(valid_system_calls)
-
-    # Regular expressions for parsing of strace log
-    _open_re       = re.compile(r'(?P<pid>\d+)\s+open\("(?P<name>[^"]*)", (?P<mode>[^,)]*)')
-    _openat_re     = re.compile(r'(?P<pid>\d+)\s+openat\(.+?, "(?P<name>[^"]*)", (?P<mode>[^,)]*).*\)\s*=\s*(?P<result>-*\d*)')
-    _stat_re       = re.compile(r'(?P<pid>\d+)\s+l?stat(?:64)?\("(?P<name>[^"]*)", .*') # stat,lstat,stat64,lstat64
-    _execve_re     = re.compile(r'(?P<pid>\d+)\s+execve\("(?P<name>[^"]*)", .*')
-    _creat_re      = re.compile(r'(?P<pid>\d+)\s+creat\("(?P<name>[^"]*)", .*')
-    _mkdir_re      = re.compile(r'(?P<pid>\d+)\s+mkdir\("(?P<name>[^"]*)", .*\)\s*=\s(?P<result>-?[0-9]*).*')
-    _rename_re     = re.compile(r'(?P<pid>\d+)\s+rename\("[^"]*", "(?P<name>[^"]*)"\)')
-    _symlink_re    = re.compile(r'(?P<pid>\d+)\s+symlink\("[^"]*", "(?P<name>[^"]*)"\)')
-    _kill_re       = re.compile(r'(?P<pid>\d+)\s+killed by.*')
-    _chdir_re      = re.compile(r'(?P<pid>\d+)\s+chdir\("(?P<cwd>[^"]*)"\)')
-    _exit_group_re = re.compile(r'(?P<pid>\d+)\s+exit_group\((?P<status>.*)\).*')
-    _clone_re      = re.compile(r'(?P<pid_clone>\d+)\s+(clone|fork|vfork)\(.*\)\s*=\s*(?P<pid>\d*)')
-
-    # Regular expressions for detecting interrupted lines in strace log
-    # 3618  clone( <unfinished ...>
-    # 3618  <... clone resumed> child_stack=0, flags=CLONE, child_tidptr=0x7f83deffa780) = 3622
-    _unfinished_start_re = re.compile(r'(?P<pid>\d+)(?P<body>.*)<unfinished ...>$')
-    _unfinished_end_re   = re.compile(r'(?P<pid>\d+)\s+\<\.\.\..*\>(?P<body>.*)')
-
-    def _do_strace(self, args, kwargs, outfile, outname):
-        """ Run strace on given command args/kwargs, sending output to file.
+        key = '%s:%d:%d:%d' % (strace, st.st_ino, st.st_size, st.st_mtime_ns)
+        probe = StraceRunner._probed_system_calls.get(key)
+        if probe is not None:
+            return probe
+        cache_name = os.path.join(user_cache_dir(), 'strace.json')
+        try:
+            with open(cache_name) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+        probe = cache.get(key)
+        if probe is None or \
+                probe.get('probed') != StraceRunner.possible_system_calls or \
+                probe.get('probed_options') != StraceRunner.possible_options:
+            try:
+                calls, options, version = StraceRunner._probe_strace(strace)
+            except OSError:
+                return None
+            probe = {'probed': StraceRunner.possible_system_calls,
+                     'probed_options': StraceRunner.possible_options,
+                     'calls': calls, 'options': options, 'version': version}
+            cache[key] = probe
+            try:
+                if not os.path.isdir(user_cache_dir()):
+                    os.makedirs(user_cache_dir())
+                temp = '%s.%d' % (cache_name, os.getpid())
+                with open(temp, 'w') as f:
+                    json.dump(cache, f, indent=4, sort_keys=True)
+                os.replace(temp, cache_name)
+            except (IOError, OSError):
+                pass                    # the cache is only an optimisation
+        StraceRunner._probed_system_calls[key] = probe
+        return probe
+
+    @staticmethod
+    def _probe_strace(strace):
+        """ Return (calls, options, version) for strace, where calls is a
+            comma separated list of the possible_system_calls it supports
+            and options the list of possible_options it accepts. All the
+            calls are tried in one run of strace, which names the first
+            invalid call, so runs are only repeated to drop invalid calls. """
+        valid_system_calls = list(StraceRunner.possible_system_calls)
+        while True:
+            # strace checks -e then prints its version for -V and exits
+            proc = subprocess.Popen([strace, '-e',
+                                     'trace=' + ','.join(valid_system_calls),
+                                     '-V'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            stdout, stderr = proc.communicate()
+            if b'invalid system call' not in stderr:
+                version = stdout.decode('utf-8', 'replace').strip()
+                calls = ','.join(valid_system_calls)
+                return calls, StraceRunner._probe_options(strace, calls), \
+                       version
+            match = StraceRunner._invalid_call_re.search(
+                stderr.decode('utf-8', 'replace'))
+            if match is None or match.group(1) not in valid_system_calls:
+                break
+            valid_system_calls.remove(match.group(1))
+        # strace didn't say which call was invalid, so try them one by one
+        valid_system_calls = []
+        for system_call in StraceRunner.possible_system_calls:
+            proc = subprocess.Popen([strace, '-e', 'trace=' + system_call],
+                                    stderr=subprocess.PIPE)
+            stdout, stderr = proc.communicate()
+            if b'invalid system call' not in stderr:
+                valid_system_calls.append(system_call)
+        calls = ','.join(valid_system_calls)
+        return calls, StraceRunner._probe_options(strace, calls), ''
+
+    @staticmethod
+    def _probe_options(strace, calls):
+        """ Return the list of possible_options strace accepts alongside
+            the way _do_strace runs it. strace rejects an unknown option
+            before it gets to -V, which makes it exit successfully. """
+        options = []
+        for option in StraceRunner.possible_options:
+            proc = subprocess.Popen([strace, option, '-f', '-e',
+                                     'trace=' + calls, '-V'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            proc.communicate()
+            if proc.returncode == 0:
+                options.append(option)
+        return options
+
+    def _do_strace(self, args, kwargs, fifo, logfile=None):
+        """ Run strace on given command args/kwargs, sending its output
+            through the named pipe fifo to be parsed on a reader thread
+            while the command runs, and copied to logfile if given.
             Return (status code, list of dependencies, list of outputs). """
         shell_keywords = dict(silent=False)
         shell_keywords.update(kwargs)
+        self.status = 0
+        self._check_path_names()
+        processes  = {}  # dictionary of processes (key = pid)
+        unfinished = {}  # list of interrupted entries in strace log
+        lines = []       # number of lines strace wrote
+        errors = []
+
+        def parse(f):
+            count = 0
+            try:
+                for line in f:
+                    count += 1
+                    if errors:
+                        continue        # keep reading so strace isn't blocked
+                    try:
+                        if logfile is not None:
+                            logfile.write(line)
+                        self._match_line(line, processes, unfinished)
+                    except Exception:
+                        errors.append(sys.exc_info())
+            finally:
+                lines.append(count)
+
+        # open both ends here, so strace can open the fifo straight away and
+        # the reader sees the end of it once strace and "writer" are closed
+        reader_fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        writer = os.open(fifo, os.O_WRONLY)
+        os.set_blocking(reader_fd, True)
+        reader_file = os.fdopen(reader_fd, 'rb')
+        reader = threading.Thread(target=parse, args=[reader_file])
+        reader.daemon = True
+        reader.start()
         try:
-            shell('strace', '-fo', outname, '-e',
-                  'trace=' + self.strace_system_calls,
-                  args, **shell_keywords)
+            try:
+                shell('strace', '-fo', fifo, self.strace_options, '-e',
+                      'trace=' + self.strace_system_calls,
+                      args, **shell_keywords)
+            finally:
+                os.close(writer)
+                reader.join()
+                reader_file.close()
         except ExecutionError as e:
             # if strace failed to run, re-throw the exception
-            # we can tell this happend if the file is empty
-            outfile.seek(0, os.SEEK_END)
-            if outfile.tell() is 0:
+            # we can tell this happend if it wrote nothing
+            if not lines or not lines[0]:
                 raise e
-            else:
-                # reset the file postion for reading
-                outfile.seek(0)
+        if errors:
+            etype, value, tb = errors[0]
+            raise value.with_traceback(tb)
 
-        self.status = 0
-        processes  = {}  # dictionary of processes (key = pid)
-        unfinished = {}  # list of interrupted entries in strace log
-        for line in outfile:
-            self._match_line(line, processes, unfinished)
-
-        # collect outputs and dependencies from all processes
+        # collect outputs and dependencies from all processes, leaving out
+        # files that didn't exist once the command finished
         deps = set()
         outputs = set()
         for pid, process in processes.items():
-            deps = deps.union(process.deps)
-            outputs = outputs.union(process.outputs)
-
-        return self.status, list(deps), list(outputs)
+            deps.update(process.deps)
+            outputs.update(process.outputs)
+        lexists = os.path.lexists
+        return (self.status, [dep for dep in deps if lexists(dep)],
+                [output for output in outputs if lexists(output)])
+
+    # Lines of strace output look like 'PID  name(args) = result'. A call
+    # interrupted by another process is split into 'PID  name(args
+    # <unfinished ...>' and 'PID  <... name resumed>args) = result'.
+    _unfinished_suffix = b'<unfinished ...>'
+    _resumed_prefix = b'<... '
 
     def _match_line(self, line, processes, unfinished):
-        # look for split lines
-        unfinished_start_match = self._unfinished_start_re.match(line)
-        unfinished_end_match = self._unfinished_end_re.match(line)
-        if unfinished_start_match:
-            pid = unfinished_start_match.group('pid')
-            body = unfinished_start_match.group('body')
-            unfinished[pid] = pid + ' ' + body
+        """ Parse a line (bytes) of strace output, passing it to the handler
+            in _syscall_handlers for its system call. """
+        pid, _, body = line.rstrip(b'\n').partition(b' ')
+        body = body.lstrip()
+        if body.endswith(self._unfinished_suffix):
+            unfinished[pid] = body[:-len(self._unfinished_suffix)]
             return
-        elif unfinished_end_match:
-            pid = unfinished_end_match.group('pid')
-            body = unfinished_end_match.group('body')
+        if body.startswith(self._resumed_prefix):
             if pid not in unfinished:
-                  # Looks like we need to hande an strace bug here
-                  # I think it is safe to ignore as I have only seen futex calls which strace should not output
-                   printerr('fabricate: Warning: resume without unfinished in strace output (strace bug?), \'%s\'' % line.strip())
-                   return
-            line = unfinished[pid] + body
-            del unfinished[pid]
-
-        is_output = False
-        open_match = self._open_re.match(line)
-        openat_match = self._openat_re.match(line)
-        stat_match = self._stat_re.match(line)
-        execve_match = self._execve_re.match(line)
-        creat_match = self._creat_re.match(line)
-        mkdir_match = self._mkdir_re.match(line)
-        symlink_match = self._symlink_re.match(line)
-        rename_match = self._rename_re.match(line)
-        clone_match = self._clone_re.match(line)
-
-        kill_match = self._kill_re.match(line)
-        if kill_match:
-            return None, None, None
-
-        match = None
-        if execve_match:
-            pid = execve_match.group('pid')
-            match = execve_match # Executables can be dependencies
-            if pid not in processes and len(processes) == 0:
-                # This is the first process so create dict entry
-                processes[pid] = StraceProcess()
-        elif clone_match:
-            pid = clone_match.group('pid')
-            pid_clone = clone_match.group('pid_clone')
-            if pid not in processes:
-                # Simple case where there are no delayed lines
-                processes[pid] = StraceProcess(processes[pid_clone].cwd)
+                # Looks like we need to hande an strace bug here
+                # I think it is safe to ignore as I have only seen futex calls which strace should not output
+                printerr('fabricate: Warning: resume without unfinished in strace output (strace bug?), \'%s\''
+                         % line.strip().decode('utf-8', 'replace'))
+                return
+            body = unfinished.pop(pid) + body[body.find(b'>') + 1:]
+        name, paren, args = body.partition(b'(')
+        if not paren:
+            return                      # a signal, exit or kill
+        handler = self._syscall_handlers.get(name)
+        if handler is not None:
+            handler(self, pid, args, pid + b' ' + body, processes)
+
+    def _add_path(self, processes, pid, line, name, is_output):
+        """ Record the path name (bytes) as a dependency or output of
+            process pid, if it's relevant. """
+        if not name or self._matching_is_delayed(processes, pid, line):
+            return
+        cwd = processes[pid].cwd
+        key = cwd, name
+        if key in self._path_names:
+            name = self._path_names[key]
+        else:
+            name = self._path_names[key] = self._relevant_name(cwd, name)
+        if name is not None:
+            if is_output:
+                processes[pid].add_output(name)
             else:
-                # Some line processing was delayed due to an interupted clone_match
-                processes[pid].cwd = processes[pid_clone].cwd # Set the correct cwd
-                processes[pid].delayed = False # Set that matching is no longer delayed
-                for delayed_line in processes[pid].delayed_lines:
-                    # Process all the delayed lines
-                    self._match_line(delayed_line, processes, unfinished)
-                processes[pid].delayed_lines = [] # Clear the lines
-        elif open_match:
-            match = open_match
-            mode = match.group('mode')
-            if 'O_WRONLY' in mode or 'O_RDWR' in mode:
-                # it's an output file if opened for writing
-                is_output = True
-        elif openat_match:
-            match = openat_match
-            mode = match.group('mode')
-            if 'O_WRONLY' in mode or 'O_RDWR' in mode:
-                # it's an output file if opened for writing
-                is_output = True
-        elif stat_match:
-            match = stat_match
-        elif creat_match:
-            match = creat_match
-            # a created file is an output file
-            is_output = True
-        elif mkdir_match:
-            match = mkdir_match
-            if match.group('result') == '0':
-                # a created directory is an output file
-                is_output = True
-        elif symlink_match:
-            match =  symlink_match
-            # the created symlink is an output file
-            is_output = True
-        elif rename_match:
-            match = rename_match
-            # the destination of a rename is an output file
-            is_output = True
-
-        if match:
-            name = match.group('name')
-            pid  = match.group('pid')
-            if not self._matching_is_delayed(processes, pid, line):
-                cwd = processes[pid].cwd
-                if cwd != '.':
-                    name = os.path.join(cwd, name)
-
-                # normalise path name to ensure files are only listed once
-                name = os.path.normpath(name)
-
-                # if it's an absolute path name under the build directory,
-                # make it relative to build_dir before saving to .deps file
-                if os.path.isabs(name) and name.startswith(self.build_dir):
-                    name = name[len(self.build_dir):]
-                    name = name.lstrip(os.path.sep)
-
-                if (self._builder._is_relevant(name)
-                    and not self.ignore(name)
-                    and os.path.lexists(name)):
-                    if is_output:
-                        processes[pid].add_output(name)
-                    else:
-                        processes[pid].add_dep(name)
-
-        match = self._chdir_re.match(line)
-        if match:
-            pid  = match.group('pid')
-            if not self._matching_is_delayed(processes, pid, line):
-                processes[pid].cwd = os.path.join(processes[pid].cwd, match.group('cwd'))
-
-        match = self._exit_group_re.match(line)
-        if match:
-            self.status = int(match.group('status'))
+                processes[pid].add_dep(name)
+
+    def _check_path_names(self):
+        """ Forget the memoised _path_names if the working directory or the
+            builder's settings they were worked out with have changed. """
+        builder = self._builder
+        settings = (os.getcwd(), tuple(builder.dirs), builder.dirdepth,
+                    builder.ignoreprefix, builder.ignore.pattern)
+        if settings != self._path_settings:
+            self._path_names = {}
+            self._path_settings = settings
+
+    def _relevant_name(self, cwd, name):
+        """ Return the name to record for path name (bytes) opened in
+            directory cwd, or None if it isn't relevant. Results are
+            memoised in _path_names, as the same paths (such as headers)
+            are seen by many commands. """
+        name = os.fsdecode(name)
+        if cwd != '.':
+            name = os.path.join(cwd, name)
+
+        # normalise path name to ensure files are only listed once
+        name = os.path.normpath(name)
+
+        # if it's an absolute path name under the build directory,
+        # make it relative to build_dir before saving to .deps file
+        if os.path.isabs(name) and name.startswith(self.build_dir):
+            name = name[len(self.build_dir):]
+            name = name.lstrip(os.path.sep)
+
+        if self._builder._is_relevant(name) and not self.ignore(name):
+            return name
+        return None
+
+    # the *at variants of calls have a directory fd before the path, so
+    # their handlers pass _strace_at_path() as the path parser
+
+    def _parse_open(self, pid, args, line, processes, path=_strace_string):
+        name, end = path(args)
+        mode = args[end:args.find(b')', end)]
+        # it's an output file if opened for writing
+        is_output = b'O_WRONLY' in mode or b'O_RDWR' in mode
+        self._add_path(processes, pid, line, name, is_output)
+
+    def _parse_openat(self, pid, args, line, processes):
+        self._parse_open(pid, args, line, processes, _strace_at_path)
+
+    def _parse_dep(self, pid, args, line, processes, path=_strace_string):
+        self._add_path(processes, pid, line, path(args)[0], False)
+
+    def _parse_dep_at(self, pid, args, line, processes):
+        self._parse_dep(pid, args, line, processes, _strace_at_path)
+
+    def _parse_execve(self, pid, args, line, processes):
+        if pid not in processes and len(processes) == 0:
+            # This is the first process so create dict entry
+            processes[pid] = StraceProcess()
+        self._parse_dep(pid, args, line, processes)
+
+    def _parse_creat(self, pid, args, line, processes):
+        # a created file is an output file
+        self._add_path(processes, pid, line, _strace_string(args)[0], True)
+
+    def _parse_mkdir(self, pid, args, line, processes, path=_strace_string):
+        # a created directory is an output file
+        created = _strace_result(args) == b'0'
+        self._add_path(processes, pid, line, path(args)[0], created)
+
+    def _parse_mkdirat(self, pid, args, line, processes):
+        self._parse_mkdir(pid, args, line, processes, _strace_at_path)
+
+    def _parse_second_path(self, pid, args, line, processes,
+                           path=_strace_string):
+        # the new name of rename(at) or symlink(at) is an output file
+        name, end = _strace_string(args)
+        name, end = path(args, args.find(b',', end) + 1)
+        self._add_path(processes, pid, line, name, True)
+
+    def _parse_second_path_at(self, pid, args, line, processes):
+        self._parse_second_path(pid, args, line, processes, _strace_at_path)
+
+    def _parse_clone(self, pid_clone, args, line, processes):
+        pid = _strace_result(args)
+        if not pid.isdigit():
+            return
+        if pid not in processes:
+            # Simple case where there are no delayed lines
+            processes[pid] = StraceProcess(processes[pid_clone].cwd)
+        else:
+            # Some line processing was delayed due to an interupted clone
+            processes[pid].cwd = processes[pid_clone].cwd # Set the correct cwd
+            processes[pid].delayed = False # Set that matching is no longer delayed
+            for delayed_line in processes[pid].delayed_lines:
+                # Process all the delayed lines
+                self._match_line(delayed_line, processes, {})
+            processes[pid].delayed_lines = [] # Clear the lines
+
+    def _parse_chdir(self, pid, args, line, processes):
+        if not self._matching_is_delayed(processes, pid, line):
+            cwd = os.fsdecode(_strace_string(args)[0] or b'')
+            processes[pid].cwd = os.path.join(processes[pid].cwd, cwd)
+
+    def _parse_exit_group(self, pid, args, line, processes):
+        try:
+            self.status = int(args.partition(b')')[0])
+        except ValueError:
+            pass
+
+    _syscall_handlers = {
+        b'open': _parse_open,
+        b'openat': _parse_openat,
+        b'openat2': _parse_openat,
+        b'stat': _parse_dep,
+        b'stat64': _parse_dep,
+        b'lstat': _parse_dep,
+        b'lstat64': _parse_dep,
+        b'newfstatat': _parse_dep_at,
+        b'statx': _parse_dep_at,
+        b'execve': _parse_execve,
+        b'creat': _parse_creat,
+        b'mkdir': _parse_mkdir,
+        b'mkdirat': _parse_mkdirat,
+        b'rename': _parse_second_path,
+        b'renameat': _parse_second_path_at,
+        b'renameat2': _parse_second_path_at,
+        b'symlink': _parse_second_path,
+        b'symlinkat': _parse_second_path_at,
+        b'clone': _parse_clone,
+        b'clone3': _parse_clone,
+        b'fork': _parse_clone,
+        b'vfork': _parse_clone,
+        b'chdir': _parse_chdir,
+        b'exit_group': _parse_exit_group,
+        }
 
     def _matching_is_delayed(self, processes, pid, line):
         # Check if matching is delayed and cache a delayed line
@@ -722,29 +1330,22 @@ class StraceRunner(Runner):
             to determine dependencies (by looking at what files are opened or
             modified). """
         ignore_status = kwargs.pop('ignore_status', False)
+        logfile = None
         if self.keep_temps:
-            outname = 'strace%03d.txt' % self.temp_count
+            logfile = open('strace%03d.txt' % self.temp_count, 'wb')
             self.temp_count += 1
-            handle = os.open(outname, os.O_CREAT)
-        else:
-            handle, outname = tempfile.mkstemp()
-
+        tempdir = tempfile.mkdtemp()
         try:
-            try:
-                outfile = os.fdopen(handle, 'r')
-            except:
-                os.close(handle)
-                raise
-            try:
-                status, deps, outputs = self._do_strace(args, kwargs, outfile, outname)
-                if status is None:
-                    raise ExecutionError(
-                        '%r was killed unexpectedly' % args[0], '', -1)
-            finally:
-                outfile.close()
+            fifo = os.path.join(tempdir, 'strace')
+            os.mkfifo(fifo)
+            status, deps, outputs = self._do_strace(args, kwargs, fifo, logfile)
+            if status is None:
+                raise ExecutionError(
+                    '%r was killed unexpectedly' % args[0], '', -1)
         finally:
-            if not self.keep_temps:
-                os.remove(outname)
+            if logfile is not None:
+                logfile.close()
+            shutil.rmtree(tempdir, ignore_errors=True)
 
         if status and not ignore_status:
             raise ExecutionError('%r exited with status %d'
@@ -980,6 +1581,685 @@ def _results_handler( builder, delay=0.01):
             printerr("Error: unexpected results handler exit")
             os._exit(1)
 
+def deps_file_format(filename):
+    """ Return the format of dependency file filename ("json", "compact",
+        "indexed" or "sqlite"), or None if it doesn't exist. """
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        magic = f.read(16)
+    finally:
+        f.close()
+    if magic == b'SQLite format 3\0':
+        return 'sqlite'
+    if magic == CompactDepsFile.marker[:16].encode('ascii'):
+        return 'compact'
+    if magic in _indexed_entries:
+        return 'indexed'
+    return 'json'
+
+def _seen_list(commands, meta):
+    """ Return a copy of meta with its ".deps_seen" dict, of the last build
+        that ran or checked each command, replaced by a list of the stamps
+        of commands in order, so that the file doesn't hold each command a
+        second time. Commands without a stamp were last seen in the build
+        before ".deps_build". """
+    meta = dict(meta)
+    seen = meta.get('.deps_seen', {})
+    previous = meta.get('.deps_build', 1) - 1
+    meta['.deps_seen'] = [seen.get(command, previous) for command in commands]
+    return meta
+
+def _seen_dict(commands, meta):
+    """ Replace the ".deps_seen" list in meta, as made by _seen_list() for
+        commands, with a dict mapping each command to its stamp. """
+    seen = meta.get('.deps_seen')
+    if isinstance(seen, list):
+        if len(seen) == len(commands):
+            meta['.deps_seen'] = dict(zip(commands, seen))
+        else:
+            del meta['.deps_seen']
+
+class JsonDepsFile(object):
+    """ A dependency file in JSON format. It holds one object mapping each
+        command to an object of its dependencies' and outputs' hashes, and
+        metadata entries whose names start with ".deps_". The ".deps_seen"
+        stamps are a list in the order of the sorted commands. """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def read(self):
+        """ Return (deps, meta), where deps is a dict of the commands and
+            meta a dict of the metadata entries. Raise IOError if the file
+            doesn't exist. """
+        f = open(self.filename)
+        try:
+            deps = json.load(f)
+        finally:
+            f.close()
+        meta = dict((key, deps.pop(key)) for key in list(deps)
+                    if key.startswith('.deps_'))
+        _seen_dict(sorted(deps), meta)
+        return deps, meta
+
+    def write(self, deps, meta):
+        """ Write the commands in deps and the metadata in meta to the file. """
+        data = dict(deps.items())
+        data.update(_seen_list(sorted(data), meta))
+        temp = self.filename + '.tmp'
+        f = open(temp, 'w')
+        try:
+            json.dump(data, f, indent=4, sort_keys=True)
+        finally:
+            f.close()
+        os.replace(temp, self.filename)
+
+class SqliteDeps(collections.abc.MutableMapping):
+    """ Mapping of commands to dicts of their dependencies' and outputs'
+        hashes, like the deps dict read from a JSON dependency file, but
+        stored in an SQLite database. A command's entry is only read when
+        it is looked up, and each assignment updates just that command's
+        rows, so a build only pays for the commands it reaches. """
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS commands (
+            id INTEGER PRIMARY KEY, command TEXT NOT NULL UNIQUE,
+            seen INTEGER);
+        CREATE TABLE IF NOT EXISTS paths (
+            id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS hashes (
+            command_id INTEGER NOT NULL, path_id INTEGER NOT NULL,
+            hash TEXT NOT NULL, PRIMARY KEY (command_id, path_id))
+            WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS hashes_path ON hashes (path_id);
+    """
+
+    def __init__(self, filename, journal_mode='WAL'):
+        if sqlite3 is None:
+            raise ImportError('SqliteDeps requires the sqlite3 module')
+        self.filename = os.path.abspath(filename)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._path_ids = {}
+        created = not os.path.exists(self.filename)
+        self._db = sqlite3.connect(self.filename, timeout=60,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=' + journal_mode)
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(self._schema)
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(commands)')]
+        if 'seen' not in columns:
+            self._db.execute('ALTER TABLE commands ADD COLUMN seen INTEGER')
+        if created:
+            # commands are saved before the rest of the metadata, so record
+            # which version they are in straight away
+            self._db.execute('INSERT OR IGNORE INTO meta VALUES (?,?)',
+                             ('.deps_version', json.dumps(deps_version)))
+
+    def _command_id(self, command):
+        row = self._db.execute('SELECT id FROM commands WHERE command=?',
+                               (command,)).fetchone()
+        return row and row[0]
+
+    def _path_id(self, path):
+        if path not in self._path_ids:
+            self._db.execute('INSERT OR IGNORE INTO paths (path) VALUES (?)',
+                             (path,))
+            self._path_ids[path] = self._db.execute(
+                'SELECT id FROM paths WHERE path=?', (path,)).fetchone()[0]
+        return self._path_ids[path]
+
+    def _store(self, command, deps):
+        self._db.execute('INSERT OR IGNORE INTO commands (command) VALUES (?)',
+                         (command,))
+        command_id = self._command_id(command)
+        self._db.execute('DELETE FROM hashes WHERE command_id=?',
+                         (command_id,))
+        self._db.executemany('INSERT INTO hashes VALUES (?,?,?)',
+                             [(command_id, self._path_id(path), hashed)
+                              for path, hashed in deps.items()])
+
+    def __getitem__(self, command):
+        with self._lock:
+            if command not in self._cache:
+                command_id = self._command_id(command)
+                if command_id is None:
+                    raise KeyError(command)
+                self._cache[command] = dict(self._db.execute(
+                    'SELECT path, hash FROM hashes JOIN paths '
+                    'ON paths.id=path_id WHERE command_id=?', (command_id,)))
+            return self._cache[command]
+
+    def __setitem__(self, command, deps):
+        with self._lock:
+            with self._db:
+                self._db.execute('BEGIN IMMEDIATE')
+                self._store(command, deps)
+            self._cache[command] = deps
+
+    def __delitem__(self, command):
+        with self._lock:
+            command_id = self._command_id(command)
+            if command_id is None:
+                raise KeyError(command)
+            with self._db:
+                self._db.execute('BEGIN IMMEDIATE')
+                self._db.execute('DELETE FROM hashes WHERE command_id=?',
+                                 (command_id,))
+                self._db.execute('DELETE FROM commands WHERE id=?',
+                                 (command_id,))
+            self._cache.pop(command, None)
+
+    def __iter__(self):
+        with self._lock:
+            commands = [row[0] for row in
+                        self._db.execute('SELECT command FROM commands')]
+        return iter(commands)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM commands').fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            with self._db:
+                self._db.execute('BEGIN IMMEDIATE')
+                self._db.execute('DELETE FROM hashes')
+                self._db.execute('DELETE FROM commands')
+            self._cache = {}
+
+    def items(self):
+        """ Return a list of (command, deps dict) for every command, read
+            with a single query. """
+        with self._lock:
+            entries = {}
+            for command, path, hashed in self._db.execute(
+                    'SELECT command, path, hash FROM commands '
+                    'LEFT JOIN hashes ON command_id=commands.id '
+                    'LEFT JOIN paths ON paths.id=path_id'):
+                deps = entries.setdefault(command, {})
+                if path is not None:
+                    deps[path] = hashed
+            entries.update(self._cache)
+        return list(entries.items())
+
+    def recorded_paths(self):
+        """ Return the set of every path recorded for any command. """
+        with self._lock:
+            return set(row[0] for row in self._db.execute(
+                'SELECT path FROM paths WHERE id IN '
+                '(SELECT path_id FROM hashes)'))
+
+    def update_all(self, deps):
+        """ Store every command in the deps mapping in one transaction. """
+        with self._lock:
+            with self._db:
+                self._db.execute('BEGIN IMMEDIATE')
+                for command, command_deps in deps.items():
+                    self._store(command, command_deps)
+
+    def seen(self, command):
+        """ Return the last build that ran or checked command, as stored in
+            its row, or None. """
+        with self._lock:
+            row = self._db.execute('SELECT seen FROM commands WHERE command=?',
+                                   (command,)).fetchone()
+        return row and row[0]
+
+    def read_meta(self):
+        """ Return a dict of the metadata entries. """
+        with self._lock:
+            return dict((key, json.loads(value)) for key, value
+                        in self._db.execute('SELECT key, value FROM meta'))
+
+    def write_meta(self, meta):
+        """ Replace the metadata entries with those in the meta dict. The
+            ".deps_seen" stamps are stored in the commands' rows instead,
+            keeping the later build where a row already has one. """
+        meta = dict(meta)
+        seen = meta.pop('.deps_seen', {})
+        previous = meta.get('.deps_build', 1) - 1
+        values = dict((key, json.dumps(value, sort_keys=True))
+                      for key, value in meta.items())
+        with self._lock:
+            with self._db:
+                self._db.execute('BEGIN IMMEDIATE')
+                # only write the entries that changed, as the stat cache's
+                # entry can be large
+                stored = dict(self._db.execute('SELECT key, value FROM meta'))
+                self._db.executemany('DELETE FROM meta WHERE key=?',
+                                     [(key,) for key in stored
+                                      if key not in values])
+                self._db.executemany('INSERT OR REPLACE INTO meta '
+                                     'VALUES (?,?)',
+                                     [(key, value) for key, value
+                                      in values.items()
+                                      if stored.get(key) != value])
+                self._db.executemany(
+                    'UPDATE commands SET seen=MAX(IFNULL(seen, 0), ?) '
+                    'WHERE command=?',
+                    [(build, command) for command, build in seen.items()])
+                self._db.execute('UPDATE commands SET seen=? '
+                                 'WHERE seen IS NULL', (previous,))
+
+    def close(self):
+        self._db.close()
+
+class SqliteDepsFile(object):
+    """ A dependency file in an SQLite database (in WAL mode), read into a
+        SqliteDeps mapping. Commands are written as they complete, so at
+        exit only the metadata is left to write. """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def read(self):
+        """ Return (deps, meta) as per JsonDepsFile.read(), where deps is a
+            SqliteDeps. The database is created if it doesn't exist. """
+        deps = SqliteDeps(self.filename)
+        return deps, deps.read_meta()
+
+    def write(self, deps, meta):
+        """ Write the commands in deps and the metadata in meta to the file,
+            replacing it with a new database if deps isn't already stored
+            in it (for example when converting a JSON dependency file). """
+        filename = os.path.abspath(self.filename)
+        if isinstance(deps, SqliteDeps) and deps.filename == filename:
+            deps.write_meta(meta)
+            return
+        temp = filename + '.tmp'
+        if os.path.exists(temp):
+            os.remove(temp)
+        new = SqliteDeps(temp, journal_mode='DELETE')
+        try:
+            new.update_all(deps)
+            new.write_meta(meta)
+        finally:
+            new.close()
+        os.replace(temp, filename)
+
+class _CompactEntry(object):
+    """ A command's entry in CompactDeps: columns of ids into the shared
+        path and hash tables. """
+    __slots__ = ('paths', 'hashes')
+
+    def __init__(self, paths, hashes):
+        self.paths = paths
+        self.hashes = hashes
+
+class CompactDeps(collections.abc.MutableMapping):
+    """ Mapping of commands to dicts of their dependencies' and outputs'
+        hashes which stores each distinct path and hash string only once.
+        Every command holds just two arrays of integer ids into the shared
+        path and hash tables, so the header paths and hashes repeated over
+        thousands of commands cost a few bytes per use instead of a string
+        each. Looking up a command returns a new dict. """
+
+    def __init__(self, paths=(), hashes=()):
+        self._lock = threading.Lock()
+        self._paths = list(paths)
+        self._path_ids = dict((path, i) for i, path in enumerate(self._paths))
+        self._hashes = list(hashes)
+        self._hash_ids = dict((hashed, i)
+                              for i, hashed in enumerate(self._hashes))
+        self._entries = {}
+
+    def _intern(self, value, table, ids):
+        if value not in ids:
+            ids[value] = len(table)
+            table.append(value)
+        return ids[value]
+
+    def set_ids(self, command, path_ids, hash_ids):
+        """ Set command's entry from sequences of path and hash ids. """
+        self._entries[command] = _CompactEntry(array.array('I', path_ids),
+                                               array.array('I', hash_ids))
+
+    def __getitem__(self, command):
+        entry = self._entries[command]
+        paths = self._paths
+        hashes = self._hashes
+        return dict((paths[p], hashes[h])
+                    for p, h in zip(entry.paths, entry.hashes))
+
+    def __setitem__(self, command, deps):
+        with self._lock:
+            path_ids = [self._intern(path, self._paths, self._path_ids)
+                        for path in deps]
+            hash_ids = [self._intern(hashed, self._hashes, self._hash_ids)
+                        for hashed in deps.values()]
+            self.set_ids(command, path_ids, hash_ids)
+
+    def __delitem__(self, command):
+        del self._entries[command]
+
+    def __contains__(self, command):
+        return command in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def recorded_paths(self):
+        """ Return the set of every path recorded for any command. """
+        ids = set()
+        for entry in list(self._entries.values()):
+            ids.update(entry.paths)
+        return set(self._paths[i] for i in ids)
+
+    def tables(self):
+        """ Return (paths, hashes, commands): the path and hash tables
+            holding only strings still in use, and a dict mapping each
+            command to a flat list of alternating path and hash ids into
+            them. """
+        with self._lock:
+            paths, path_ids = [], {}
+            hashes, hash_ids = [], {}
+            commands = {}
+            for command, entry in self._entries.items():
+                ids = []
+                for p, h in zip(entry.paths, entry.hashes):
+                    ids.append(self._intern(self._paths[p], paths, path_ids))
+                    ids.append(self._intern(self._hashes[h], hashes,
+                                            hash_ids))
+                commands[command] = ids
+        return paths, hashes, commands
+
+class CompactDepsFile(object):
+    """ A dependency file in compact JSON format, read into a CompactDeps.
+        It starts with a marker, then has the metadata entries, a "paths"
+        table, a "hashes" table and a "commands" object mapping each
+        command to a list of alternating path and hash table indexes. The
+        ".deps_seen" stamps are a list in the order of the sorted commands,
+        as JSON objects' order isn't kept when they are read. """
+
+    marker = '{".deps_format":"compact",'
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def read(self):
+        """ Return (deps, meta) as per JsonDepsFile.read(), where deps is a
+            CompactDeps. """
+        f = open(self.filename)
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        data.pop('.deps_format', None)
+        deps = CompactDeps(data.pop('paths'), data.pop('hashes'))
+        commands = data.pop('commands')
+        for command, ids in commands.items():
+            deps.set_ids(command, ids[0::2], ids[1::2])
+        _seen_dict(sorted(commands), data)
+        return deps, data
+
+    def write(self, deps, meta):
+        """ Write the commands in deps and the metadata in meta to the file. """
+        if not isinstance(deps, CompactDeps):
+            compact = CompactDeps()
+            for command, command_deps in deps.items():
+                compact[command] = command_deps
+            deps = compact
+        paths, hashes, commands = deps.tables()
+        data = _seen_list(sorted(commands), meta)
+        data['paths'] = paths
+        data['hashes'] = hashes
+        data['commands'] = commands
+        temp = self.filename + '.tmp'
+        f = open(temp, 'w')
+        try:
+            f.write(self.marker)
+            f.write(json.dumps(data, separators=(',', ':'))[1:])
+        finally:
+            f.close()
+        os.replace(temp, self.filename)
+
+def _command_key(command):
+    """ Return the 64-bit key of command in an indexed dependency file. """
+    return struct.unpack('<Q', md5func(command.encode('utf-8')).digest()[:8])[0]
+
+def _set_key(command):
+    """ Return the key of a command's dep set in ".deps_command_sets": its
+        dependency file key if that is a command digest, otherwise the
+        digest of its command line, so command lines aren't saved twice. """
+    if command.startswith('md5-'):
+        return command
+    return 'md5-' + md5func(command.encode('utf-8')).hexdigest()
+
+def _set_id(dep_set):
+    """ Return the id of dep_set, a dict of input paths and their hashes. """
+    return md5func(json.dumps(sorted(dep_set.items()))
+                   .encode('utf-8')).hexdigest()
+
+class IndexedDeps(collections.abc.MutableMapping):
+    """ Mapping of commands to dicts of their dependencies' and outputs'
+        hashes read from a memory-mapped indexed dependency file. Looking up
+        a command binary searches the file's index of command keys and
+        decodes only that command's record, so the cost of starting a build
+        doesn't depend on how many commands the file holds. Changes are
+        kept in memory until the file is written. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._changed = {}
+        self._deleted = set()
+        f = open(filename, 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        (magic, self._count, self._index_offset, self._meta_offset,
+         self._meta_length) = _indexed_header.unpack_from(self._map)
+        if magic not in _indexed_entries:
+            raise ValueError('%s is not an indexed dependency file' % filename)
+        self._entry = _indexed_entries[magic]
+
+    def _index_entry(self, i):
+        """ Return (key, offset, length, seen) of the i'th index entry,
+            where seen is None if the file doesn't store it. """
+        entry = self._entry.unpack_from(
+            self._map, self._index_offset + i * self._entry.size)
+        return entry if len(entry) == 4 else entry + (None,)
+
+    def _record(self, offset, length):
+        """ Return (command, raw deps JSON) of the record at offset. """
+        record = self._map[offset:offset+length]
+        command, sep, deps = record.partition(b'\0')
+        return command.decode('utf-8'), deps
+
+    def _find(self, command):
+        """ Return (raw deps JSON, seen) of command in the file, or None. """
+        key = _command_key(command)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._index_entry(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self._count:
+            entry_key, offset, length, seen = self._index_entry(low)
+            if entry_key != key:
+                break
+            found, deps = self._record(offset, length)
+            if found == command:
+                return deps, seen
+            low += 1
+        return None
+
+    def meta(self):
+        """ Return the dict of metadata entries stored in the file. """
+        return json.loads(self._map[self._meta_offset:
+                                    self._meta_offset + self._meta_length]
+                          .decode('utf-8'))
+
+    def raw_records(self):
+        """ Yield (command, raw deps JSON, seen) for each command in the file
+            that hasn't been changed or deleted since it was read. """
+        for i in range(self._count):
+            key, offset, length, seen = self._index_entry(i)
+            command, deps = self._record(offset, length)
+            if command not in self._changed and command not in self._deleted:
+                yield command, deps, seen
+
+    def seen(self, command):
+        """ Return the last build that ran or checked command, as stored in
+            the file, or None. """
+        found = self._find(command)
+        return found and found[1]
+
+    def __getitem__(self, command):
+        if command in self._changed:
+            return self._changed[command]
+        if command not in self._deleted:
+            found = self._find(command)
+            if found is not None:
+                # callers assign entries they update, so only those are
+                # encoded again when the file is written
+                return json.loads(found[0].decode('utf-8'))
+        raise KeyError(command)
+
+    def __contains__(self, command):
+        if command in self._changed:
+            return True
+        return command not in self._deleted and self._find(command) is not None
+
+    def __setitem__(self, command, deps):
+        self._deleted.discard(command)
+        self._changed[command] = deps
+
+    def __delitem__(self, command):
+        if command not in self:
+            raise KeyError(command)
+        self._changed.pop(command, None)
+        self._deleted.add(command)
+
+    def __iter__(self):
+        commands = [command for command, deps, seen in self.raw_records()]
+        commands.extend(self._changed)
+        return iter(commands)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def close(self):
+        self._map.close()
+
+# header layout of indexed dependency files, and index entry layouts by
+# magic: version 1 entries don't have the last build that saw the command
+_indexed_header = struct.Struct('<16sQQQQ')
+_indexed_entries = {
+    b'fabricate-index\x01': struct.Struct('<QQQ'),
+    b'fabricate-index\x02': struct.Struct('<QQQQ'),
+    }
+
+class IndexedDepsFile(object):
+    """ A binary dependency file with an index of commands, read into an
+        IndexedDeps. It holds a header (magic, command count and the
+        offsets of the index and metadata), a record per command (the
+        command, a NUL and its deps as JSON), the index (an entry of
+        command key, record offset and length and the last build that saw
+        the command per command, sorted by key) and the metadata as JSON. """
+
+    magic = b'fabricate-index\x02'
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def read(self):
+        """ Return (deps, meta) as per JsonDepsFile.read(), where deps is
+            an IndexedDeps. """
+        deps = IndexedDeps(self.filename)
+        return deps, deps.meta()
+
+    def write(self, deps, meta):
+        """ Write the commands in deps and the metadata in meta to the file.
+            Records of commands read from an IndexedDeps and not changed
+            are copied without being decoded. """
+        if isinstance(deps, IndexedDeps):
+            records = list(deps.raw_records())
+            changed = [(command, command_deps, deps.seen(command))
+                       for command, command_deps in deps._changed.items()]
+        else:
+            records = []
+            changed = [(command, command_deps, None)
+                       for command, command_deps in deps.items()]
+        records.extend((command, json.dumps(command_deps).encode('utf-8'),
+                        stored) for command, command_deps, stored in changed)
+        # the stamps go in the index, keeping the later build where the
+        # file already has one
+        meta = dict(meta)
+        seen = meta.pop('.deps_seen', {})
+        previous = meta.get('.deps_build', 1) - 1
+        entry_struct = _indexed_entries[self.magic]
+        temp = self.filename + '.tmp'
+        f = open(temp, 'wb')
+        try:
+            f.write(b'\0' * _indexed_header.size)
+            index = []
+            for command, raw_deps, stored in records:
+                record = command.encode('utf-8') + b'\0' + raw_deps
+                stamp = max(seen.get(command, 0), stored or 0) or previous
+                index.append((_command_key(command), f.tell(), len(record),
+                              stamp))
+                f.write(record)
+            index.sort()
+            index_offset = f.tell()
+            for entry in index:
+                f.write(entry_struct.pack(*entry))
+            meta_offset = f.tell()
+            meta_data = json.dumps(meta).encode('utf-8')
+            f.write(meta_data)
+            f.seek(0)
+            f.write(_indexed_header.pack(self.magic, len(index), index_offset,
+                                         meta_offset, len(meta_data)))
+        finally:
+            f.close()
+        os.replace(temp, self.filename)
+
+def _try_lock(f):
+    """ Try to take an exclusive lock on open file f, without waiting.
+        Return False if another process holds a lock on it. """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        return False
+    return True
+
+# commands with dep_sets need at least this many shared inputs to use a set
+dep_set_min_size = 8
+
+# the dependency journal is fsynced after this many commands or seconds
+journal_sync_count = 64
+journal_sync_time = 1.0
+
+def _migrate_v1(deps, meta):
+    """ Version 1 stored bare hashes without saying which paths were
+        outputs. Record them all as inputs: they are still checked, and
+        each command's outputs are marked again when it is next run. """
+    for command in list(deps):
+        deps[command] = dict((dep, 'input-' + hashed)
+                             for dep, hashed in deps[command].items())
+
+# functions that upgrade the deps object and metadata of each old
+# dependency file version to the next version, in place
+deps_migrations = {
+    1: _migrate_v1,
+    }
+
 class Builder(object):
     """ The Builder.
 
@@ -999,7 +2279,11 @@ class Builder(object):
 
     def __init__(self, runner=None, dirs=None, dirdepth=100, ignoreprefix='.',
                  ignore=None, hasher=md5_hasher, depsname='.deps',
-                 quiet=False, debug=False, inputs_only=False, parallel_ok=False):
+                 quiet=False, debug=False, inputs_only=False, parallel_ok=False,
+                 stat_cache=False, hash_jobs=0, dir_hashing=None,
+                 shared_hash_cache=None, immutable_dirs=None, deps_format=None,
+                 journal=False, targets=None, command_digests=False,
+                 changed_set=False, dep_sets=False):
         r""" Initialise a Builder with the given options.
 
         "runner" specifies how programs should be run.  It is either a
@@ -1021,9 +2305,13 @@ class Builder(object):
             Note that the regex may be VERBOSE (spaces are ignored and # line
             comments allowed -- use \ prefix to insert these characters)
         "hasher" is a function which returns a string which changes when
-            the contents of its filename argument changes, or None on error.
-            Default is md5_hasher, but can also be mtime_hasher.
-        "depsname" is the name of the JSON dependency file to load/save.
+            the contents of its filename argument changes, or None on error,
+            or the name of one of the "hashers" ("md5", "sha1", "blake2b",
+            "blake2s", "mtime", "stat", "md5tree" or "git"). Default is
+            md5_hasher. Entries recorded by a different named hasher are
+            re-hashed with the current one when their old hash shows they
+            are unchanged.
+        "depsname" is the name of the dependency file to load/save.
         "quiet" set to True tells the builder to not display the commands being
             executed (or other non-error output).
         "debug" set to True makes the builder print debug output, such as why
@@ -1032,22 +2320,141 @@ class Builder(object):
             have changed (ignores output hashes); use with tools that touch
             files that shouldn't cause a rebuild; e.g. g++ collect phase
         "parallel_ok" set to True to indicate script is safe for parallel running
+        "stat_cache" set to True stores a stat fingerprint (size, mtime,
+            ctime, inode and device) with each file's hash in the .deps file
+            and only re-runs the hasher on files whose fingerprint differs
+        "hash_jobs" is the number of threads used to hash every file
+            recorded in the .deps file as soon as it is loaded, so that
+            run() only waits for the hashes it needs. 0 hashes lazily.
+        "dir_hashing" changes how directory inputs are hashed. None (the
+            default) uses the hasher, which hashes just the name of a
+            directory. "listing" hashes the names and types of its entries,
+            and "contents" also hashes each entry's contents, recursing
+            into subdirectories. Entries starting with ignoreprefix are
+            skipped.
+        "shared_hash_cache" set to True looks up and stores the hashes of
+            files in the per-user HashCache shared by all build directories
+            before hashing them. It may also be the filename of the cache
+            or a HashCache instance. Only named "hashers" are cached.
+        "immutable_dirs" is a list of directories whose files only change
+            when they are replaced wholesale, such as toolchain install
+            directories. Files under them are hashed with stat_hasher
+            instead of having their contents read.
+        "deps_format" is the format the dependency file is saved in: "json",
+            "compact" (JSON with shared path and hash tables, held in memory
+            as arrays of ids, for builds with very many commands),
+            "indexed" (a memory-mapped binary file with an index, so only
+            the commands a build reaches are decoded) or "sqlite" (an
+            SQLite database updated as each command completes, so large
+            builds don't rewrite it all at exit). The default is "sqlite"
+            if depsname ends in .db, .sqlite or .sqlite3, otherwise "json".
+            A dependency file in any other format is still read, and
+            converted when it is saved.
+        "journal" set to True appends each command's
+            dependencies to a journal file (depsname + ".journal") as soon
+            as it completes. If the build is killed before the dependency
+            file is saved, the next build replays the journal and so only
+            reruns commands that hadn't finished. The journal is removed
+            once the dependency file is saved. The default is False, as the
+            journal is written and fsynced as the build runs.
+        "targets" is a list of output files to build. If given, run() only
+            runs the commands that the dependency file records as needed to
+            produce them: their producers, the producers of those commands'
+            inputs, and so on. Other recorded commands are skipped without
+            being checked. Commands the dependency file doesn't record, such
+            as new commands or those whose command line changed, are run as
+            usual since they may be needed. If a target has no recorded
+            producer, all commands are run.
+        "command_digests" set to True keys commands in the dependency file
+            by an MD5 digest of their arguments and working directory (with
+            absolute paths in the build directory made relative to it)
+            instead of by the command line, which keeps the file small and
+            lookups fast when command lines are very long. The command
+            lines are saved once each in depsname + ".commands", which is
+            only read for debug output and to re-key entries when the
+            option is turned off. Entries saved with the option set the
+            other way are re-keyed when their commands are next run, rather
+            than the commands being rerun.
+        "changed_set" set to True checks which commands are out of date all
+            at once, when the first command is checked: each path recorded
+            in the dependency file is hashed and compared once, rather than
+            once per command that uses it, and commands using changed paths
+            are marked out of date. Commands reading the outputs of commands
+            run during the build are checked again individually.
+        "dep_sets" set to True stores the inputs of each command that aren't
+            named on its command line (such as headers) in a dep set shared
+            with the other commands that have the same inputs, if there
+            are at least dep_set_min_size of them. Each dep set is checked
+            once per build rather than once per command. Dep sets already
+            in the dependency file are used whether or not this is set.
+            New dep sets aren't made with the "sqlite" format.
         """
         if dirs is None:
             dirs = ['.']
         self.dirs = dirs
+        self._relevant_key = None
         self.dirdepth = dirdepth
         self.ignoreprefix = ignoreprefix
         if ignore is None:
             ignore = r'$x^'         # something that can't match
         self.ignore = re.compile(ignore, re.VERBOSE)
         self.depsname = depsname
+        if isinstance(hasher, str):
+            hasher = hashers[hasher]
         self.hasher = hasher
         self.quiet = quiet
         self.debug = debug
         self.inputs_only = inputs_only
         self.checking = False
         self.hash_cache = {}
+        self.stat_cache = stat_cache
+        self._stat_cache = {}
+        self.hash_jobs = hash_jobs
+        self._prehashing = {}
+        self._prehash_pool = None
+        self._old_hash_cache = {}
+        self.dir_hashing = dir_hashing
+        self._dir_hash_cache = {}
+        if shared_hash_cache is True:
+            shared_hash_cache = HashCache()
+        elif isinstance(shared_hash_cache, str):
+            shared_hash_cache = HashCache(shared_hash_cache)
+        self.shared_hash_cache = shared_hash_cache
+        if self.hasher not in hashers.values():
+            self.shared_hash_cache = None   # unnamed hashers may clash
+        self.immutable_dirs = tuple(os.path.join(os.path.abspath(path), '')
+                                    for path in immutable_dirs or ())
+        if deps_format is None:
+            extension = os.path.splitext(depsname)[1]
+            if extension in ('.db', '.sqlite', '.sqlite3'):
+                deps_format = 'sqlite'
+            else:
+                deps_format = 'json'
+        self.deps_format = deps_format
+        self.journal = journal
+        self._journal_file = None
+        self._journal_lock = threading.Lock()
+        self._build_number = 1
+        self._seen = {}
+        self.targets = targets
+        self._target_commands = None
+        self._producers = None
+        self._consumers = None
+        self.command_digests = command_digests
+        self._commands = {}
+        self._unsaved_commands = set()
+        self._saved_commands = None
+        self._saved_keys = None
+        self._updated = set()
+        self._deps_stamp = None
+        self.changed_set = changed_set
+        self._dirty = None
+        self._recheck = set()
+        self.dep_sets = dep_sets
+        self._sets = {}
+        self._command_sets = {}
+        self._set_verdicts = {}
+        self._set_paths = None
 
         # instantiate runner after the above have been set in case it needs them
         if runner is not None:
@@ -1106,7 +2513,26 @@ class Builder(object):
             raise TypeError('run() takes at least 1 argument (0 given)')
         # we want a command line string for the .deps file key and for display
         command = subprocess.list2cmdline(arglist)
-        if not self.cmdline_outofdate(command):
+        key = command
+        if self.command_digests:
+            key = self._digest_key(arglist, kwargs.get('cwd'))
+            self._commands[key] = command
+            if key not in self.deps:
+                self._unsaved_commands.add(key)
+                if command in self.deps:
+                    self._rekey(command, key)
+        elif command not in self.deps:
+            self._read_commands()
+            digest = self._saved_keys.get(command)
+            if digest is not None and digest in self.deps:
+                self._rekey(digest, command)
+        if (self.targets is not None and key in self.deps and
+                not self._targeted(key)):
+            self._seen[key] = self._build_number
+            if self.parallel_ok:
+                _groups.ensure(group)
+            return command, None, None
+        if not self.cmdline_outofdate(key):
             if self.parallel_ok:
                 _groups.ensure(group)
             return command, None, None
@@ -1130,15 +2556,123 @@ class Builder(object):
                 # count this blocked command as well as usual commands
                 _groups.inc_count_for_blocked(group)
                 _groups.add(False,
-                            _after(after, _todo(group, command, arglist,
+                            _after(after, _todo(group, key, arglist,
                                                 kwargs)))
             else:
                 async = _pool.apply_async(_call_strace, arglist, kwargs)
-                _groups.add(group, _running(async, command))
+                _groups.add(group, _running(async, key))
             return None
         else:
             deps, outputs = self.runner(*arglist, **kwargs)
-            return self.done(command, deps, outputs)
+            _, deps, outputs = self.done(key, deps, outputs)
+            return command, deps, outputs
+
+    def _digest_key(self, arglist, cwd):
+        """ Return the dependency file key of the command in arglist run
+            in directory cwd when command_digests is on. The directory, and
+            arguments that are absolute paths in the build directory, are
+            made relative to the build directory, so that keys don't change
+            when it is moved. Such arguments are marked as absolute, so they
+            don't get the key of the same path given relatively. """
+        build_dir = os.path.join(os.getcwd(), '')
+        def relative(path):
+            if (os.path.isabs(path) and
+                    os.path.join(path, '').startswith(build_dir)):
+                return os.path.relpath(path, build_dir)
+            return None
+        hash = md5func()
+        cwd = os.path.normpath(cwd or '.')
+        hash.update((relative(cwd) or cwd).encode('utf-8') + b'\0')
+        for arg in arglist:
+            path = relative(arg)
+            if path is None:
+                hash.update(b'=' + arg.encode('utf-8') + b'\0')
+            else:
+                hash.update(b'/' + path.encode('utf-8') + b'\0')
+        return 'md5-' + hash.hexdigest()
+
+    def _rekey(self, old, new):
+        """ Move the entry saved under dependency file key old to key new,
+            when command_digests has been turned on or off since it was
+            saved, so that the command isn't rerun just for that. """
+        all_deps = self.deps
+        deps = all_deps[old]
+        all_deps[new] = deps
+        del all_deps[old]
+        self._commands.pop(old, None)
+        self._updated.update([old, new])
+        for table in (self._seen, self._dirty):
+            if table is not None and old in table:
+                table[new] = table.pop(old)
+        if _set_key(old) in self._command_sets:
+            self._command_sets[_set_key(new)] = self._command_sets.pop(
+                _set_key(old))
+        for commands in (self._recheck, self._target_commands):
+            if commands is not None and old in commands:
+                commands.discard(old)
+                commands.add(new)
+        if self._producers is not None:
+            for dep, hashed in self._full_deps(new, deps).items():
+                path = os.path.abspath(dep)
+                if hashed.startswith('output-'):
+                    if self._producers.get(path) == old:
+                        self._producers[path] = new
+                else:
+                    self._consumers[path].discard(old)
+                    self._consumers[path].add(new)
+        self.echo_debug('re-keyed %r' % self.command_line(new))
+
+    def command_line(self, command):
+        """ Return the command line of the given dependency file key. """
+        if command in self._commands:
+            return self._commands[command]
+        return self._read_commands().get(command, command)
+
+    def _read_commands(self):
+        """ Return the dict of command lines saved by key in the commands
+            file (depsname + ".commands"), reading it the first time. """
+        if self._saved_commands is None:
+            try:
+                f = open(self.depsname + '.commands')
+                try:
+                    self._saved_commands = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                self._saved_commands = {}
+            self._saved_keys = dict((command, key) for key, command
+                                    in self._saved_commands.items())
+        return self._saved_commands
+
+    def _write_commands(self, depsname):
+        """ Save the command lines of the digest keys in the deps object to
+            depsname + ".commands". Saving the build's own dependency file
+            leaves the file alone unless a key was added or it was read to
+            re-key entries, so most builds don't read or write it. """
+        own = os.path.abspath(depsname) == os.path.abspath(self.depsname)
+        added = [key for key in self._unsaved_commands if key in self._deps]
+        if own and not added and self._saved_commands is None:
+            return
+        # read it again, as another build may have saved it since
+        self._saved_commands = None
+        commands = self._read_commands()
+        commands.update((key, self._commands[key]) for key in added)
+        commands = dict((key, command) for key, command in commands.items()
+                        if key in self._deps)
+        filename = depsname + '.commands'
+        if commands:
+            temp = filename + '.tmp'
+            f = open(temp, 'w')
+            try:
+                json.dump(commands, f, indent=4, sort_keys=True)
+            finally:
+                f.close()
+            os.replace(temp, filename)
+        elif os.path.exists(filename):
+            os.remove(filename)
+        if own:
+            self._unsaved_commands = set()
+            self._saved_commands = self._saved_keys = None
 
     def run(self, *args, **kwargs):
         """ Run command given in args with kwargs per shell(), but only if its
@@ -1164,30 +2698,376 @@ class Builder(object):
         if deps is not None or outputs is not None:
             deps_dict = {}
 
+            # any hash fetched before the command ran is now stale,
+            # including those of directories the outputs were created in
+            for output in outputs:
+                self._prehashing.pop(output, None)
+                if self.dir_hashing:
+                    self._forget_dir_hashes(output)
+
             # hash the dependency inputs and outputs
             for dep in deps:
-                if dep in self.hash_cache:
-                    # already hashed so don't repeat hashing work
-                    hashed = self.hash_cache[dep]
-                else:
-                    hashed = self.hasher(dep)
+                hashed = self._io_hash(dep, 'input')
                 if hashed is not None:
                     deps_dict[dep] = "input-" + hashed
-                    # store hash in hash cache as it may be a new file
-                    self.hash_cache[dep] = hashed
 
             for output in outputs:
-                hashed = self.hasher(output)
+                hashed = self._hash(output)
                 if hashed is not None:
                     deps_dict[output] = "output-" + hashed
                     # update hash cache as this file should already be in
                     # there but has probably changed
                     self.hash_cache[output] = hashed
 
-            self.deps[command] = deps_dict
+            if self.changed_set:
+                # commands reading the outputs must be checked again
+                for output in outputs:
+                    self._recheck.update(self.consumers(output))
+            for output in outputs:
+                # dep sets including the outputs must be checked again
+                for set_id in self._sets_with(output):
+                    self._set_verdicts.pop(set_id, None)
+
+            self._index(command, deps_dict)
+            all_deps = self.deps    # load them before changing dep sets
+            # SQLite saves entries straight away but dep sets only at exit,
+            # so a killed build would leave entries missing their sets
+            if self.dep_sets and not isinstance(all_deps, SqliteDeps):
+                all_deps[command] = self._intern(command, deps_dict)
+            else:
+                all_deps[command] = deps_dict
+                self._command_sets.pop(_set_key(command), None)
+            self._updated.add(command)
+            self._seen[command] = self._build_number
+            if self.journal and not isinstance(self._deps, SqliteDeps):
+                self._write_journal(command, deps_dict)
 
         return command, deps, outputs
 
+    def _intern(self, command, deps_dict):
+        """ Move the inputs in deps_dict that aren't named on command's
+            command line to a dep set, if there are at least
+            dep_set_min_size of them, and return the remaining entries. """
+        named = set(self.command_line(command).split())
+        shared = dict((dep, hashed) for dep, hashed in deps_dict.items()
+                      if hashed.startswith('input-') and dep not in named)
+        if len(shared) < dep_set_min_size:
+            self._command_sets.pop(_set_key(command), None)
+            return deps_dict
+        set_id = _set_id(shared)
+        if set_id not in self._sets:
+            self._sets[set_id] = shared
+            self._set_paths = None
+        self._command_sets[_set_key(command)] = set_id
+        return dict((dep, hashed) for dep, hashed in deps_dict.items()
+                    if dep not in shared)
+
+    def _full_deps(self, command, deps):
+        """ Return deps, command's entry in the deps object, together with
+            the entries of its dep set if it has one. """
+        set_id = self._command_sets.get(_set_key(command))
+        if set_id is None:
+            return deps
+        full = dict(self._sets[set_id])
+        full.update(deps)
+        return full
+
+    def _sets_with(self, path):
+        """ Return the ids of the dep sets that include path. """
+        if not self._sets:
+            return ()
+        if self._set_paths is None:
+            self._set_paths = {}
+            for set_id, dep_set in self._sets.items():
+                for dep in dep_set:
+                    self._set_paths.setdefault(dep, []).append(set_id)
+        return self._set_paths.get(path, ())
+
+    def _set_outofdate(self, set_id):
+        """ Return why the inputs in dep set set_id have changed, or None
+            if they haven't. Each dep set is only checked once per build. """
+        if set_id not in self._set_verdicts:
+            reason = None
+            rehashed = {}
+            for dep, hashed in self._sets[set_id].items():
+                oldhash = hashed.split('-', 1)[1]
+                newhash = self._io_hash(dep, 'input')
+                if newhash is None:
+                    reason = "input %s doesn't exist" % dep
+                    break
+                if newhash != oldhash:
+                    if self._unchanged_by_old_hasher(dep, oldhash, newhash):
+                        rehashed[dep] = 'input-' + newhash
+                        continue
+                    reason = 'hash for input %s (%s) != old hash (%s)' % (
+                        dep, newhash, oldhash)
+                    break
+            if reason is None and rehashed:
+                set_id = self._rehash_set(set_id, rehashed)
+            self._set_verdicts[set_id] = reason
+        return self._set_verdicts[set_id]
+
+    def _rehash_set(self, set_id, rehashed):
+        """ Update dep set set_id with the rehashed dict of its inputs'
+            hashes by the current hasher, moving it and the commands that
+            use it to the set's new id. Return the new id. """
+        dep_set = dict(self._sets.pop(set_id))
+        dep_set.update(rehashed)
+        new_id = _set_id(dep_set)
+        self._sets[new_id] = dep_set
+        for key, used in self._command_sets.items():
+            if used == set_id:
+                self._command_sets[key] = new_id
+        self._set_verdicts.pop(set_id, None)
+        self._set_paths = None
+        return new_id
+
+    def _write_journal(self, command, deps_dict):
+        """ Append command's entry to the journal. Every entry is flushed
+            so it survives the build being killed; the journal is fsynced
+            in batches of journal_sync_count entries or journal_sync_time
+            seconds so it also survives most system crashes. """
+        with self._journal_lock:
+            if self._journal_file is None:
+                self._journal_file = open(self._journal_name, 'a')
+                if not _try_lock(self._journal_file):
+                    # another build is journaling, so use a journal of our own
+                    self._journal_file.close()
+                    self._journal_file = open('%s.%d' % (self._journal_name,
+                                                         os.getpid()), 'a')
+                    _try_lock(self._journal_file)
+                if self._journal_file.tell() == 0:
+                    self._journal_file.write(
+                        json.dumps({'.deps_version': deps_version}) + '\n')
+                self._journal_unsynced = 0
+                self._journal_synced = time.time()
+            self._journal_file.write(json.dumps([command, deps_dict]) + '\n')
+            self._journal_file.flush()
+            self._journal_unsynced += 1
+            if (self._journal_unsynced >= journal_sync_count or
+                    time.time() - self._journal_synced >= journal_sync_time):
+                os.fsync(self._journal_file.fileno())
+                self._journal_unsynced = 0
+                self._journal_synced = time.time()
+
+    def _journals(self):
+        """ Return the paths of this dependency file's journals: depsname +
+            ".journal", and depsname + ".journal." + pid for each build that
+            found that journal in use. """
+        directory, base = os.path.split(self._journal_name)
+        prefix = base + '.'
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            names = []
+        return [self._journal_name] + [
+            os.path.join(directory, name) for name in names
+            if name.startswith(prefix) and name[len(prefix):].isdigit()]
+
+    def _replay_journal(self):
+        """ Apply the entries of the journals left by builds that didn't
+            save the dependency file, dropping any partly written last entry.
+            Journals still locked by running builds are skipped. """
+        self._replayed_journals = []
+        for journal in self._journals():
+            try:
+                f = open(journal, 'r+')
+            except IOError:
+                continue
+            try:
+                if _try_lock(f):
+                    self._replay_journal_file(f)
+                    self._replayed_journals.append(journal)
+            finally:
+                f.close()
+
+    def _replay_journal_file(self, f):
+        """ Apply the entries of the open journal file f. """
+        count = 0
+        header = f.readline()
+        try:
+            version = json.loads(header).get('.deps_version')
+        except ValueError:
+            version = None
+        if version != deps_version:
+            f.truncate(0)
+            return
+        good = f.tell()
+        for line in iter(f.readline, ''):
+            try:
+                if not line.endswith('\n'):
+                    raise ValueError('partly written entry')
+                command, deps = json.loads(line)
+            except ValueError:
+                break
+            self._deps[command] = deps
+            self._command_sets.pop(_set_key(command), None)
+            self._updated.add(command)
+            count += 1
+            good = f.tell()
+        f.truncate(good)
+        self.echo_debug('replayed %d commands from %s' % (count, f.name))
+
+    def _remove_journal(self):
+        """ Close and delete this build's journal and the journals it
+            replayed, unless another build has since started using them. """
+        with self._journal_lock:
+            journals = list(getattr(self, '_replayed_journals', []))
+            if self._journal_file is not None:
+                journals.append(self._journal_file.name)
+                self._journal_file.close()
+                self._journal_file = None
+            self._replayed_journals = []
+            for journal in journals:
+                try:
+                    f = open(journal, 'r')
+                except IOError:
+                    continue
+                try:
+                    if _try_lock(f):
+                        os.remove(journal)
+                except OSError:
+                    pass
+                finally:
+                    f.close()
+
+    def _io_hash(self, filename, io_type):
+        """ Return the hash of filename used when it is recorded as an
+            io_type ('input' or 'output'). """
+        if (self.dir_hashing and io_type == 'input' and
+                os.path.isdir(filename) and not os.path.islink(filename)):
+            return self._dir_hash(filename)
+        return self._cached_hash(filename)
+
+    def _dir_hash(self, path):
+        """ Return "dir:" and the MD5 of the sorted (name, type[, hash])
+            records of directory path's entries, as per "dir_hashing". File
+            hashes come from the hash cache, so unchanged trees cost little
+            more than a scandir() per directory. """
+        if path in self._dir_hash_cache:
+            return self._dir_hash_cache[path]
+        try:
+            entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+        except OSError:
+            return None
+        ignoreprefix = self.ignoreprefix
+        hash = md5func()
+        for entry in entries:
+            if ignoreprefix and entry.name.startswith(ignoreprefix):
+                continue
+            child = os.path.join(path, entry.name)
+            if entry.is_symlink():
+                kind, hashed = 'l', os.readlink(child)
+            elif entry.is_dir():
+                kind, hashed = 'd', ''
+                if self.dir_hashing == 'contents':
+                    hashed = self._dir_hash(child)
+            elif entry.is_file():
+                kind, hashed = 'f', ''
+                if self.dir_hashing == 'contents':
+                    hashed = self._cached_hash(child)
+            else:
+                kind, hashed = 'o', ''
+            hash.update(('%s\0%s\0%s\n' % (entry.name, kind, hashed or ''))
+                        .encode('utf-8', 'surrogateescape'))
+        hashed = _tag('dir', hash.hexdigest())
+        self._dir_hash_cache[path] = hashed
+        return hashed
+
+    def _forget_dir_hashes(self, output):
+        """ Remove the cached hashes of output and its parent directories,
+            whose listings or contents output may have changed. """
+        path = os.path.normpath(output)
+        while path:
+            self._dir_hash_cache.pop(path, None)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        self._dir_hash_cache.pop('.', None)
+
+    def _cached_hash(self, filename):
+        """ Return the hash of filename from the hash cache, waiting for it
+            to be prehashed or hashing it if it isn't there yet. """
+        if filename in self.hash_cache:
+            # already hashed so don't repeat hashing work
+            return self.hash_cache[filename]
+        future = self._prehashing.pop(filename, None)
+        if future is not None:
+            hashed = future.result()
+        else:
+            hashed = self._hash(filename)
+        if hashed is not None:
+            self.hash_cache[filename] = hashed
+        return hashed
+
+    def _prehash(self):
+        """ Start hashing every file recorded in the .deps file on a pool of
+            hash_jobs threads. Files are queued by directory then inode
+            (where stat_cache knows it) to reduce disk seeks. """
+        paths = self._recorded_paths()
+        def disk_order(path):
+            entry = self._stat_cache.get(path)
+            return os.path.dirname(path), entry[3] if entry else 0, path
+        self._prehash_pool = concurrent.futures.ThreadPoolExecutor(
+            self.hash_jobs)
+        for path in sorted(paths, key=disk_order):
+            self._prehashing[path] = self._prehash_pool.submit(self._hash,
+                                                               path)
+
+    def _stop_prehash(self):
+        """ Cancel hashing the files still queued by _prehash() and wait for
+            those being hashed, so that the stat cache isn't changed while
+            it's saved and exiting doesn't wait for the whole queue. """
+        if self._prehash_pool is None:
+            return
+        for future in self._prehashing.values():
+            future.cancel()
+        self._prehash_pool.shutdown(wait=True)
+        self._prehash_pool = None
+        self._prehashing = dict((path, future) for path, future
+                                in self._prehashing.items()
+                                if not future.cancelled())
+
+    def _hash(self, filename):
+        """ Return the hash of filename given by the hasher, or by
+            stat_hasher if it is under one of the immutable_dirs. If
+            stat_cache is on, the hash recorded with filename's stat
+            fingerprint is returned instead when the fingerprint is
+            unchanged, and otherwise the shared_hash_cache is tried before
+            the hasher. """
+        if (self.immutable_dirs and
+                os.path.abspath(filename).startswith(self.immutable_dirs)):
+            return stat_hasher(filename)
+        shared = self.shared_hash_cache
+        if not self.stat_cache and shared is None:
+            return self.hasher(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            self._stat_cache.pop(filename, None)
+            return self.hasher(filename)
+        fingerprint = stat_fingerprint(st)
+        entry = self._stat_cache.get(filename)
+        if entry is not None and entry[:-1] == fingerprint:
+            return entry[-1]
+        changed = max(st.st_mtime_ns, st.st_ctime_ns) / 1e9
+        racy = time.time() - changed <= stat_racy_time
+        hashed = None
+        if shared is not None and stat.S_ISREG(st.st_mode):
+            hashed = shared.get(st, _hasher_name(self.hasher))
+            if hashed is None:
+                hashed = self.hasher(filename)
+                if hashed is not None and not racy:
+                    shared.put(st, _hasher_name(self.hasher), hashed)
+        else:
+            hashed = self.hasher(filename)
+        if self.stat_cache and hashed is not None and not racy:
+            self._stat_cache[filename] = fingerprint + [hashed]
+        else:
+            self._stat_cache.pop(filename, None)
+        return hashed
+
     def memoize(self, command, **kwargs):
         """ Run the given command, but only if its dependencies have changed --
             like run(), but returns the status code instead of raising an
@@ -1217,54 +3097,284 @@ class Builder(object):
 
     def cmdline_outofdate(self, command):
         """ Return True if given command line is out of date. """
-        if command in self.deps:
+        deps = self.deps.get(command)
+        self._seen[command] = self._build_number
+        if (deps is not None and self.changed_set and
+                command not in self._recheck):
+            if self._dirty is None:
+                self._find_dirty()
+            reason = self._dirty.get(command)
+            if reason is None:
+                return False
+            self.echo_debug('rebuilding %r, %s'
+                            % (self.command_line(command), reason))
+            return True
+        set_id = self._command_sets.get(_set_key(command))
+        if deps is not None and set_id is not None:
+            reason = self._set_outofdate(set_id)
+            if reason is not None:
+                self.echo_debug('rebuilding %r, %s'
+                                % (self.command_line(command), reason))
+                return True
+        if deps is not None:
             # command has been run before, see if deps have changed
-            for dep, oldhash in self.deps[command].items():
+            rehashed = {}
+            for dep, oldhash in deps.items():
                 assert oldhash.startswith('input-') or \
                        oldhash.startswith('output-'), \
                     "%s file corrupt, do a clean!" % self.depsname
                 io_type, oldhash = oldhash.split('-', 1)
 
                 # make sure this dependency or output hasn't changed
-                if dep in self.hash_cache:
-                    # already hashed so don't repeat hashing work
-                    newhash = self.hash_cache[dep]
-                else:
-                    # not in hash_cache so make sure this dependency or
-                    # output hasn't changed
-                    newhash = self.hasher(dep)
-                    if newhash is not None:
-                       # Add newhash to the hash cache
-                       self.hash_cache[dep] = newhash
+                newhash = self._io_hash(dep, io_type)
 
                 if newhash is None:
                     self.echo_debug("rebuilding %r, %s %s doesn't exist" %
-                                    (command, io_type, dep))
+                                    (self.command_line(command), io_type, dep))
                     break
                 if newhash != oldhash and (not self.inputs_only or io_type == 'input'):
+                    if self._unchanged_by_old_hasher(dep, oldhash, newhash):
+                        rehashed[dep] = io_type + '-' + newhash
+                        continue
                     self.echo_debug("rebuilding %r, hash for %s %s (%s) != old hash (%s)" %
-                                    (command, io_type, dep, newhash, oldhash))
+                                    (self.command_line(command), io_type, dep,
+                                     newhash, oldhash))
                     break
             else:
                 # all dependencies are unchanged
+                if rehashed:
+                    deps.update(rehashed)
+                    self.deps[command] = deps
+                    self._updated.add(command)
                 return False
         else:
-            self.echo_debug('rebuilding %r, no dependency data' % command)
+            self.echo_debug('rebuilding %r, no dependency data'
+                            % self.command_line(command))
         # command has never been run, or one of the dependencies didn't
         # exist or had changed
         return True
 
+    def _find_dirty(self):
+        """ Find the out of date commands for changed_set, hashing each
+            recorded path once per hash recorded for it. Sets _dirty to a
+            dict of the reason each out of date command must be rerun. """
+        recorded = {}
+        for command, deps in self.deps.items():
+            for dep, hashed in self._full_deps(command, deps).items():
+                recorded.setdefault((dep, hashed), []).append(command)
+        dirty = {}
+        rehashed = {}
+        for (dep, hashed), commands in recorded.items():
+            io_type, oldhash = hashed.split('-', 1)
+            newhash = self._io_hash(dep, io_type)
+            if newhash is None:
+                reason = "%s %s doesn't exist" % (io_type, dep)
+            elif newhash == oldhash or (self.inputs_only and
+                                        io_type == 'output'):
+                continue
+            elif self._unchanged_by_old_hasher(dep, oldhash, newhash):
+                for command in commands:
+                    rehashed.setdefault(command, {})[dep] = \
+                        io_type + '-' + newhash
+                continue
+            else:
+                reason = 'hash for %s %s (%s) != old hash (%s)' % (
+                    io_type, dep, newhash, oldhash)
+            for command in commands:
+                dirty.setdefault(command, reason)
+        for command, updates in rehashed.items():
+            if command not in dirty:
+                deps = self.deps[command]
+                deps.update((dep, hashed) for dep, hashed in updates.items()
+                            if dep in deps)   # dep sets aren't re-keyed
+                self.deps[command] = deps
+                self._updated.add(command)
+        self._dirty = dirty
+
+    def _index(self, command, deps):
+        """ Record command's inputs and outputs in the producer and
+            consumer indexes, if they have been built. """
+        if self._producers is None:
+            return
+        for dep, hashed in deps.items():
+            path = os.path.abspath(dep)
+            if hashed.startswith('output-'):
+                self._producers[path] = command
+            else:
+                self._consumers.setdefault(path, set()).add(command)
+
+    def _build_indexes(self):
+        """ Index the commands in the deps object by the paths they read
+            and write, the first time the indexes are needed. """
+        if self._producers is None:
+            all_deps = self.deps.items()    # loading deps resets the indexes
+            self._producers = {}
+            self._consumers = {}
+            for command, deps in all_deps:
+                self._index(command, self._full_deps(command, deps))
+
+    def producer(self, path):
+        """ Return the command recorded as producing path, or None. """
+        self._build_indexes()
+        return self._producers.get(os.path.abspath(path))
+
+    def consumers(self, path):
+        """ Return a sorted list of the commands recorded as reading path. """
+        self._build_indexes()
+        return sorted(self._consumers.get(os.path.abspath(path), ()))
+
+    def needed_commands(self, targets):
+        """ Return the set of commands needed to build the target paths:
+            the commands that produce them, the commands that produce those
+            commands' inputs, and so on. Raise PathError if no command is
+            recorded as producing one of the targets. """
+        needed = set()
+        todo = []
+        for target in targets:
+            command = self.producer(target)
+            if command is None:
+                raise PathError("no command is recorded as producing '%s'"
+                                % target)
+            todo.append(command)
+        while todo:
+            command = todo.pop()
+            if command in needed:
+                continue
+            needed.add(command)
+            deps = self._full_deps(command, self.deps[command])
+            for dep, hashed in deps.items():
+                if hashed.startswith('input-'):
+                    producer = self.producer(dep)
+                    if producer is not None and producer not in needed:
+                        todo.append(producer)
+        return needed
+
+    def _targeted(self, command):
+        """ Return True if command is needed to build the targets. """
+        if self._target_commands is None:
+            try:
+                self._target_commands = self.needed_commands(self.targets)
+            except PathError as e:
+                printerr('fabricate: %s, so building everything' % e.args[0])
+                self.targets = None
+                return True
+        return command in self._target_commands
+
+    def rehash(self):
+        """ Re-key the hashes recorded by a different named hasher to the
+            current hasher, for each file the old hasher shows is unchanged,
+            including the files in dep sets, so that switching hashers
+            doesn't rerun commands. Hashes are
+            otherwise re-keyed as each command is checked. Return the number
+            of commands updated. """
+        current = _hasher_name(self.hasher)
+        count = 0
+        for command in list(self.deps):
+            deps = self.deps[command]
+            rehashed = {}
+            for dep, oldhash in deps.items():
+                io_type, oldhash = oldhash.split('-', 1)
+                if hash_algorithm(oldhash) in (None, current):
+                    continue
+                newhash = self._io_hash(dep, io_type)
+                if (newhash is not None and
+                        self._unchanged_by_old_hasher(dep, oldhash, newhash)):
+                    rehashed[dep] = io_type + '-' + newhash
+            if rehashed:
+                deps.update(rehashed)
+                self.deps[command] = deps
+                self._updated.add(command)
+                count += 1
+        for set_id in list(self._sets):
+            rehashed = {}
+            for dep, oldhash in self._sets[set_id].items():
+                oldhash = oldhash.split('-', 1)[1]
+                if hash_algorithm(oldhash) in (None, current):
+                    continue
+                newhash = self._io_hash(dep, 'input')
+                if (newhash is not None and
+                        self._unchanged_by_old_hasher(dep, oldhash, newhash)):
+                    rehashed[dep] = 'input-' + newhash
+            if rehashed:
+                self._rehash_set(set_id, rehashed)
+        return count
+
+    def _unchanged_by_old_hasher(self, dep, oldhash, newhash):
+        """ Return True if oldhash was produced by a different named hasher
+            than newhash and that hasher still gives oldhash for dep. """
+        old_algorithm = hash_algorithm(oldhash)
+        if old_algorithm is None or old_algorithm == hash_algorithm(newhash):
+            return False
+        key = old_algorithm, dep
+        if key not in self._old_hash_cache:
+            self._old_hash_cache[key] = hashers[old_algorithm](dep)
+        return self._old_hash_cache[key] == oldhash
+
     def autoclean(self):
         """ Automatically delete all outputs of this build as well as the .deps
             file. """
         # first build a list of all the outputs from the .deps file
         outputs = []
-        dirs = []
         for command, deps in self.deps.items():
             outputs.extend(dep for dep, hashed in deps.items()
                            if hashed.startswith('output-'))
         outputs.append(self.depsname)
+        if hasattr(self._deps, 'close'):
+            self._deps.close()
+        self._remove_journal()
         self._deps = None
+        self._remove_outputs(outputs)
+        try:
+            os.remove(self.depsname + '.lock')
+        except OSError:
+            pass
+        try:
+            os.remove(self.depsname + '.commands')
+        except OSError:
+            pass
+
+    def gc(self, builds, remove_outputs=False):
+        """ Forget the dependencies of commands that haven't been run or
+            checked in the last "builds" builds, counting this one. If
+            remove_outputs is True, also delete their outputs that no
+            remaining command produces. Return the forgotten commands. """
+        oldest = self._build_number - builds + 1
+        stale = [command for command in self.deps
+                 if self._last_seen(command) < oldest]
+        outputs = set()
+        for command in stale:
+            outputs.update(dep for dep, hashed in self.deps[command].items()
+                           if hashed.startswith('output-'))
+            del self.deps[command]
+            self._command_sets.pop(_set_key(command), None)
+            self._updated.add(command)
+            self._seen.pop(command, None)
+            self._producers = self._consumers = None
+            self.echo_debug('forgetting %r, not seen in %d builds'
+                            % (self.command_line(command), builds))
+        if remove_outputs and outputs:
+            for deps in self.deps.values():
+                outputs.difference_update(dep for dep, hashed in deps.items()
+                                          if hashed.startswith('output-'))
+            self._remove_outputs(outputs)
+        return stale
+
+    def _last_seen(self, command):
+        """ Return the last build that ran or checked command. Stamps not
+            set by this build are kept by the deps object, if it stores
+            them itself, or were read from the metadata. """
+        if command in self._seen:
+            return self._seen[command]
+        if hasattr(self._deps, 'seen'):
+            build = self._deps.seen(command)
+            if build is not None:
+                return build
+        # commands not yet stamped were last seen in the previous build
+        return self._build_number - 1
+
+    def _remove_outputs(self, outputs):
+        """ Delete the given output files and directories. """
+        dirs = []
         for output in outputs:
             try:
                 os.remove(output)
@@ -1293,39 +3403,237 @@ class Builder(object):
         """ Lazy load .deps file so that instantiating a Builder is "safe". """
         if not hasattr(self, '_deps') or self._deps is None:
             self.read_deps()
+            if self.hash_jobs:
+                self._prehash()
             atexit.register(self.write_deps, depsname=os.path.abspath(self.depsname))
         return self._deps
 
     def read_deps(self):
-        """ Read dependency JSON file into deps object. """
+        """ Read dependency file into deps object, and replay any journal
+            left by a build that was killed. """
+        self._journal_name = os.path.abspath(self.depsname) + '.journal'
+        self._producers = self._consumers = None
+        self._dirty = None
+        self._set_verdicts = {}
+        self._set_paths = None
+        self._deps_stamp = self._stamp(self.depsname)
+        format = deps_file_format(self.depsname)
         try:
-            f = open(self.depsname)
-            try:
-                self._deps = json.load(f)
-                # make sure the version is correct
-                if self._deps.get('.deps_version', 0) != deps_version:
-                    printerr('Bad %s dependency file version! Rebuilding.'
-                             % self.depsname)
-                    self._deps = {}
-                self._deps.pop('.deps_version', None)
-            finally:
-                f.close()
+            deps_file = self._deps_formats[format or self.deps_format]
+            self._deps, meta = deps_file(self.depsname).read()
         except IOError:
             self._deps = {}
+            self._build_number = 1
+            self._seen = {}
+            self._sets = {}
+            self._command_sets = {}
+            self._replay_journal()
+            return
+        # upgrade an old version, or rebuild if it can't be upgraded. Only
+        # JSON files from before versioning have no version: the other
+        # formats record it, unless nothing but commands has been saved
+        old_version = meta.get('.deps_version',
+                               1 if format == 'json' else None)
+        version = old_version
+        if version is not None and version != deps_version:
+            while version in deps_migrations and version < deps_version:
+                deps_migrations[version](self._deps, meta)
+                version += 1
+            if version == deps_version:
+                self.echo_debug('upgraded %s from version %d'
+                                % (self.depsname, old_version))
+            else:
+                printerr('Bad %s dependency file version! Rebuilding.'
+                         % self.depsname)
+                self._deps.clear()
+                meta = {}
+        self._build_number = meta.get('.deps_build', 0) + 1
+        self._seen = meta.get('.deps_seen', {})
+        # older files saved the command lines in the metadata
+        for key, command in meta.get('.deps_commands', {}).items():
+            self._commands.setdefault(key, command)
+            self._unsaved_commands.add(key)
+        self._sets = meta.get('.deps_sets', {})
+        # files saved before dep sets were keyed by digest are re-keyed
+        self._command_sets = dict(
+            (_set_key(key), set_id) for key, set_id
+            in meta.get('.deps_command_sets', {}).items())
+        stat_table = meta.get('.deps_stat')
+        if (self.stat_cache and stat_table and
+                stat_table['hasher'] == _hasher_name(self.hasher)):
+            self._stat_cache = stat_table['files']
+        self._replay_journal()
 
     def write_deps(self, depsname=None):
-        """ Write out deps object into JSON dependency file. """
+        """ Write out deps object into dependency file. If another build
+            has saved the file since it was read, first merge in that
+            build's commands, keeping the entries of the commands this
+            build has run. """
+        self._stop_prehash()
+        if self.shared_hash_cache is not None:
+            self.shared_hash_cache.flush()
         if self._deps is None:
             return                      # we've cleaned so nothing to save
-        self.deps['.deps_version'] = deps_version
         if depsname is None:
             depsname = self.depsname
-        f = open(depsname, 'w')
+        lock = self._lock_deps(depsname)
+        own = os.path.abspath(depsname) == os.path.abspath(self.depsname)
         try:
-            json.dump(self.deps, f, indent=4, sort_keys=True)
+            if own:
+                self._merge_deps()
+            self._write_deps(depsname)
+            self._write_commands(depsname)
+            if own:
+                self._deps_stamp = self._stamp(depsname)
         finally:
-            f.close()
-            self._deps.pop('.deps_version', None)
+            if lock is not None:
+                # remove the lock file while holding it, so builds waiting
+                # on it see that it's gone and lock a new one
+                try:
+                    os.remove(lock.name)
+                except OSError:
+                    pass
+                lock.close()            # releases the lock
+        self._remove_journal()
+
+    def _write_deps(self, depsname):
+        """ Write the deps object and its metadata to depsname. """
+        # the file format stores the stamps of the last build that ran or
+        # checked each command with the commands themselves
+        meta = {'.deps_version': deps_version,
+                '.deps_build': self._build_number,
+                '.deps_seen': self._seen}
+        if self._command_sets:
+            live = set(_set_key(command) for command in self._deps)
+            self._command_sets = dict((key, set_id) for key, set_id
+                                      in self._command_sets.items()
+                                      if key in live)
+            used = set(self._command_sets.values())
+            self._sets = dict((set_id, dep_set) for set_id, dep_set
+                              in self._sets.items() if set_id in used)
+            self._set_paths = None
+            meta['.deps_sets'] = self._sets
+            meta['.deps_command_sets'] = self._command_sets
+        if self.stat_cache:
+            # only keep fingerprints of files still recorded in .deps
+            paths = self._recorded_paths()
+            self._stat_cache = dict((path, entry) for path, entry
+                                    in self._stat_cache.items()
+                                    if path in paths)
+            meta['.deps_stat'] = {'hasher': _hasher_name(self.hasher),
+                                  'files': self._stat_cache}
+        self._deps_formats[self.deps_format](depsname).write(self._deps, meta)
+
+    def _stamp(self, depsname):
+        """ Return the stat fingerprint of depsname, or None if it doesn't
+            exist. """
+        try:
+            return stat_fingerprint(os.stat(depsname))
+        except OSError:
+            return None
+
+    def _lock_deps(self, depsname):
+        """ Lock depsname + ".lock" so that builds sharing a dependency
+            file save it one at a time. Return the open lock file, or None
+            if file locking isn't available. The lock file is removed once
+            the dependency file is saved, so if the file locked is no longer
+            depsname + ".lock" lock that instead. """
+        if fcntl is None:
+            return None
+        while True:
+            lock = open(depsname + '.lock', 'a')
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.path.samestat(os.fstat(lock.fileno()),
+                                    os.stat(lock.name)):
+                    return lock
+            except OSError:
+                pass
+            lock.close()
+
+    def _merge_deps(self):
+        """ If the dependency file has changed since it was read, replace
+            the deps object with the file's, updated with the commands this
+            build has changed, and merge in the file's metadata. """
+        if self._stamp(self.depsname) in (None, self._deps_stamp):
+            return
+        if isinstance(self._deps, SqliteDeps):
+            # SQLite has already merged the commands
+            meta = self._deps.read_meta()
+        else:
+            format = deps_file_format(self.depsname)
+            try:
+                deps, meta = self._deps_formats[format](self.depsname).read()
+            except (IOError, KeyError, ValueError):
+                return
+            if meta.get('.deps_version', 1) != deps_version:
+                return
+            for command in self._updated:
+                if command in self._deps:
+                    deps[command] = self._deps[command]
+                elif command in deps:
+                    del deps[command]
+            if hasattr(self._deps, 'close'):
+                self._deps.close()
+            self._deps = deps
+            self._producers = self._consumers = None
+            self.echo_debug('merged %s saved by another build'
+                            % self.depsname)
+        for command, build in meta.get('.deps_seen', {}).items():
+            if build > self._seen.get(command, 0):
+                self._seen[command] = build
+        # commands this build hasn't changed keep the other build's dep sets
+        command_sets = dict((_set_key(key), set_id) for key, set_id
+                            in meta.get('.deps_command_sets', {}).items())
+        updated = set(_set_key(command) for command in self._updated)
+        for key in set(self._command_sets) | set(command_sets):
+            if key not in updated:
+                if key in command_sets:
+                    self._command_sets[key] = command_sets[key]
+                else:
+                    del self._command_sets[key]
+        for set_id, dep_set in meta.get('.deps_sets', {}).items():
+            self._sets.setdefault(set_id, dep_set)
+        self._set_paths = None
+        self._build_number = max(self._build_number,
+                                 meta.get('.deps_build', 0))
+
+    def _recorded_paths(self):
+        """ Return the set of all paths recorded in the deps object. """
+        if hasattr(self._deps, 'recorded_paths'):
+            paths = self._deps.recorded_paths()
+        else:
+            paths = set()
+            for deps in self._deps.values():
+                paths.update(deps)
+        for dep_set in self._sets.values():
+            paths.update(dep_set)
+        return paths
+
+    # state a parallel worker doesn't use when it is sent the runner (and
+    # so this builder) to run a command, which is left out of the pickle
+    _worker_unused = ('_deps', '_journal_file', '_journal_lock',
+                      '_replayed_journals', 'shared_hash_cache', 'hash_cache',
+                      '_prehashing', '_prehash_pool', '_stat_cache',
+                      '_old_hash_cache', '_dir_hash_cache', '_seen',
+                      '_commands', '_unsaved_commands', '_saved_commands',
+                      '_saved_keys', '_updated', '_producers', '_consumers',
+                      '_target_commands', '_dirty', '_recheck', '_sets',
+                      '_command_sets', '_set_verdicts', '_set_paths')
+
+    def __getstate__(self):
+        """ Return the state to pickle, leaving out _worker_unused. """
+        state = self.__dict__.copy()
+        for name in self._worker_unused:
+            state.pop(name, None)
+        return state
+
+    _deps_formats = {
+        'json' : JsonDepsFile,
+        'compact' : CompactDepsFile,
+        'indexed' : IndexedDepsFile,
+        'sqlite' : SqliteDepsFile,
+        }
 
     _runner_map = {
         'atimes_runner' : AtimesRunner,
@@ -1354,13 +3662,20 @@ class Builder(object):
         """ Return True if file is in the dependency search directories. """
 
         # need to abspath to compare rel paths with abs
-        fullname = os.path.abspath(fullname)
-        for path in self.dirs:
-            path = os.path.abspath(path)
+        cwd = os.getcwd()
+        fullname = os.path.normpath(os.path.join(cwd, fullname))
+        key = cwd, tuple(self.dirs), self.ignoreprefix
+        if key != self._relevant_key:
+            # only work out the absolute dirs again when they change
+            self._relevant_key = key
+            self._relevant_dirs = [os.path.normpath(os.path.join(cwd, path))
+                                   for path in self.dirs]
+        ignored = os.sep + self.ignoreprefix
+        for path in self._relevant_dirs:
             if fullname.startswith(path):
                 rest = fullname[len(path):]
                 # files in dirs starting with ignoreprefix are not relevant
-                if os.sep+self.ignoreprefix in os.sep+os.path.dirname(rest):
+                if ignored in os.sep+os.path.dirname(rest):
                     continue
                 # files deeper than dirdepth are not relevant
                 if rest.count(os.sep) > self.dirdepth:
@@ -1468,6 +3783,11 @@ def parse_options(usage=_usage, extra_options=None, command_line=None):
     parser.add_argument('--version', action='version', version='%(prog)s '+__version__)
     parser.add_argument('-t', '--time', action='store_true',
                       help='use file modification times instead of MD5 sums')
+    parser.add_argument('--hasher', choices=sorted(hashers),
+                      help='name of the hasher used to detect changed files')
+    parser.add_argument('--stat-cache', action='store_true',
+                      help="only re-hash files whose size, times or inode "
+                           "changed since they were last hashed")
     parser.add_argument('-d', '--dir', action='append',
                       help='add DIR to list of relevant directories')
     parser.add_argument('-c', '--clean', action='store_true',
@@ -1476,6 +3796,42 @@ def parse_options(usage=_usage, extra_options=None, command_line=None):
                       help="don't echo commands, only print errors")
     parser.add_argument('-D', '--debug', action='store_true',
                       help="show debug info (why commands are rebuilt)")
+    parser.add_argument('--dir-hashing', choices=['listing', 'contents'],
+                      help='hash the listing or contents of directory inputs '
+                           'instead of just their names')
+    parser.add_argument('--target', action='append', metavar='PATH',
+                      help='only run the commands needed to build PATH')
+    parser.add_argument('--command-digests', action='store_true',
+                      help='key commands in the dependency file by a digest '
+                           'of their arguments')
+    parser.add_argument('--rehash', action='store_true',
+                      help='re-key hashes made by another hasher before '
+                           'building')
+    parser.add_argument('--changed-set', action='store_true',
+                      help='find out of date commands by hashing each '
+                           'recorded file once')
+    parser.add_argument('--dep-sets', action='store_true',
+                      help='share the inputs commands have in common in '
+                           'dep sets checked once per build')
+    parser.add_argument('--gc', type=int, metavar='K',
+                      help="forget commands not run in the last K builds")
+    parser.add_argument('--gc-outputs', action='store_true',
+                      help='with --gc, also delete the outputs of forgotten '
+                           'commands')
+    parser.add_argument('--journal', action='store_true',
+                      help="journal dependencies as commands complete, so a "
+                           "killed build doesn't rerun them")
+    parser.add_argument('--deps-format',
+                      choices=['json', 'compact', 'indexed', 'sqlite'],
+                      help='format to save the dependency file in')
+    parser.add_argument('--immutable', action='append', metavar='DIR',
+                      help="don't read files under DIR to hash them, "
+                           "only stat them")
+    parser.add_argument('--shared-hash-cache', action='store_true',
+                      help='share file hashes with other build directories '
+                           'in a per-user cache')
+    parser.add_argument('--hash-jobs', type=int, metavar='N',
+                      help='hash files recorded in .deps on N threads')
     parser.add_argument('-k', '--keep', action='store_true',
                       help='keep temporary strace output files')
     parser.add_argument('-j', '--jobs', type=int,
@@ -1542,8 +3898,32 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
         parser, options, actions = parse_options(extra_options=extra_options, command_line=command_line)
     kwargs['quiet'] = options.quiet
     kwargs['debug'] = options.debug
+    if options.hasher:
+        kwargs['hasher'] = options.hasher
     if options.time:
         kwargs['hasher'] = mtime_hasher
+    if options.stat_cache:
+        kwargs['stat_cache'] = True
+    if options.hash_jobs:
+        kwargs['hash_jobs'] = options.hash_jobs
+    if options.dir_hashing:
+        kwargs['dir_hashing'] = options.dir_hashing
+    if options.shared_hash_cache:
+        kwargs['shared_hash_cache'] = True
+    if options.immutable:
+        kwargs['immutable_dirs'] = options.immutable
+    if options.deps_format:
+        kwargs['deps_format'] = options.deps_format
+    if options.journal:
+        kwargs['journal'] = True
+    if options.target:
+        kwargs['targets'] = options.target
+    if options.command_digests:
+        kwargs['command_digests'] = True
+    if options.changed_set:
+        kwargs['changed_set'] = True
+    if options.dep_sets:
+        kwargs['dep_sets'] = True
     if options.dir:
         kwargs['dirs'] = options.dir
     if options.keep:
@@ -1588,6 +3968,8 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
 
     if options.clean:
         default_builder.autoclean()
+    if options.rehash:
+        default_builder.rehash()
 
     status = 0
     try:
@@ -1603,10 +3985,14 @@ def main(globals_dict=None, build_dir=None, extra_options=None, builder=None,
                 printerr('%r command not defined!' % action)
                 sys.exit(1)
         after() # wait till the build commands are finished
+        if options.gc:
+            default_builder.gc(options.gc, remove_outputs=options.gc_outputs)
     except ExecutionError as exc:
         printerr('fabricate: ' + exc.args[0])
     finally:
         _stop_results.set() # stop the results gatherer so I don't hang
+        # before exiting, which would wait for every queued file to hash
+        default_builder._stop_prehash()
         if not options.quiet and os.path.abspath(build_dir) != original_path:
             print("Leaving directory '%s' back to '%s'" % (build_dir, original_path))
         os.chdir(original_path)
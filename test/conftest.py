@@ -28,6 +28,11 @@ def mock_env(request, mocker):
     mocker.patch('sys.exit'
                  )  # prevent sys.exit from existing so as to do other tests
 
+@pytest.fixture
+def no_atexit(mocker):
+    """ Stop Builders created directly by tests writing .deps at exit """
+    mocker.patch('atexit.register')
+
 @pytest.fixture
 def cleandir():
     """ Should the build directory be cleaned at the end of each test """
@@ -32,7 +32,9 @@ def test_create(builddir, runner):
             'foo.tar.gz': 'output-',
             'a.c': 'input-'
         },
-        '.deps_version': 2
+        '.deps_version': 2,
+        '.deps_build': 1,
+        '.deps_seen': [1]
     }
 
     # assertions
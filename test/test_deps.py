@@ -0,0 +1,574 @@
+import pytest
+import plumbum.cmd as sh
+from plumbum import local
+import os
+import json
+import collections
+import pickle
+
+from fabricate import *
+import fabricate
+from conftest import *
+
+EMPTY_FILE_MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
+
+def test_sqlite_deps(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.touch('a', 'b')
+        builder = Builder(runner='always_runner', depsname='deps.sqlite')
+        assert builder.deps_format == 'sqlite'
+        builder.done('cmd1', ['a'], ['b'])
+        builder.done('cmd2', ['a'], [])
+        builder.write_deps()
+        assert fabricate.deps_file_format('deps.sqlite') == 'sqlite'
+
+        builder = Builder(runner='always_runner', depsname='deps.sqlite')
+        assert isinstance(builder.deps, fabricate.SqliteDeps)
+        assert sorted(builder.deps) == ['cmd1', 'cmd2']
+        assert builder.deps['cmd1'] == {'a': 'input-' + EMPTY_FILE_MD5,
+                                        'b': 'output-' + EMPTY_FILE_MD5}
+        assert not builder.cmdline_outofdate('cmd1')
+        assert builder.cmdline_outofdate('cmd3')
+        del builder.deps['cmd2']
+        assert dict(builder.deps.items()) == {'cmd1': builder.deps['cmd1']}
+
+def test_sqlite_deps_killed_first_build(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.touch('a')
+        builder = Builder(runner='always_runner', depsname='deps.db')
+        builder.done('cmd', ['a'], [])
+        # build killed here, before the metadata was saved
+        assert builder.deps.read_meta() == {
+            '.deps_version': fabricate.deps_version}
+        builder.deps._db.execute('DELETE FROM meta')    # as in older files
+
+        builder = Builder(runner='always_runner', depsname='deps.db')
+        assert builder.deps['cmd'] == {'a': 'input-' + EMPTY_FILE_MD5}
+        assert not builder.cmdline_outofdate('cmd')
+
+def test_sqlite_meta_written_when_changed(builddir):
+    with local.cwd(builddir):
+        deps = fabricate.SqliteDeps('deps.db')
+        version = fabricate.deps_version
+        stat = {'hasher': 'md5', 'files': {'a': [1, 2, 3, 'hash']}}
+        deps.write_meta({'.deps_version': version, '.deps_build': 1,
+                         '.deps_stat': stat})
+        changes = deps._db.total_changes
+        deps.write_meta({'.deps_version': version, '.deps_build': 2,
+                         '.deps_stat': stat})
+        assert deps._db.total_changes == changes + 1    # just .deps_build
+        deps.write_meta({'.deps_version': version, '.deps_build': 3})
+        assert deps.read_meta() == {'.deps_version': version,
+                                    '.deps_build': 3}
+        deps.close()
+
+def test_json_deps_converted_to_sqlite(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.touch('a')
+        builder = Builder(runner='always_runner')
+        builder.done('cmd', ['a'], [])
+        builder.write_deps()
+        assert fabricate.deps_file_format('.deps') == 'json'
+
+        builder = Builder(runner='always_runner', deps_format='sqlite')
+        assert not builder.cmdline_outofdate('cmd')
+        builder.write_deps()
+        assert fabricate.deps_file_format('.deps') == 'sqlite'
+
+        builder = Builder(runner='always_runner')
+        assert builder.deps == {'cmd': {'a': 'input-' + EMPTY_FILE_MD5}}
+        builder.write_deps()
+        with open('.deps') as f:
+            assert json.load(f) == {
+                '.deps_version': fabricate.deps_version,
+                '.deps_build': 3,
+                '.deps_seen': [2],
+                'cmd': {'a': 'input-' + EMPTY_FILE_MD5}}
+
+def test_sqlite_autoclean(builddir, no_atexit):
+    with local.cwd(builddir):
+        builder = Builder(runner='always_runner', depsname='deps.db')
+        sh.touch('out')
+        builder.done('touch out', [], ['out'])
+        builder.autoclean()
+        assert not os.path.exists('out')
+        assert not os.path.exists('deps.db')
+
+def test_compact_deps(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.touch('header.h', 'a.c', 'b.c', 'a.o')
+        builder = Builder(runner='always_runner', deps_format='compact')
+        builder.done('cc a.c', ['a.c', 'header.h'], ['a.o'])
+        builder.done('cc b.c', ['b.c', 'header.h'], [])
+        builder.write_deps()
+        assert fabricate.deps_file_format('.deps') == 'compact'
+        with open('.deps') as f:
+            data = json.loads(f.read())
+        assert data['paths'] == ['a.c', 'header.h', 'a.o', 'b.c']
+        assert data['hashes'] == ['input-' + EMPTY_FILE_MD5,
+                                  'output-' + EMPTY_FILE_MD5]
+        assert data['commands'] == {'cc a.c': [0, 0, 1, 0, 2, 1],
+                                    'cc b.c': [3, 0, 1, 0]}
+
+        builder = Builder(runner='always_runner', deps_format='compact')
+        assert isinstance(builder.deps, fabricate.CompactDeps)
+        assert builder.deps['cc a.c'] == {'a.c': 'input-' + EMPTY_FILE_MD5,
+                                          'header.h': 'input-' + EMPTY_FILE_MD5,
+                                          'a.o': 'output-' + EMPTY_FILE_MD5}
+        assert not builder.cmdline_outofdate('cc b.c')
+        assert builder._recorded_paths() == set(['a.c', 'b.c', 'header.h', 'a.o'])
+
+        # read back as a plain dict when saving as JSON again
+        builder = Builder(runner='always_runner')
+        assert sorted(builder.deps) == ['cc a.c', 'cc b.c']
+
+def test_compact_deps_seen_in_any_order(builddir):
+    with local.cwd(builddir):
+        deps = {'cmd%d' % i: {} for i in range(10)}
+        seen = {'cmd%d' % i: i for i in range(10)}
+        fabricate.CompactDepsFile('.deps').write(
+            deps, {'.deps_build': 10, '.deps_seen': seen})
+        with open('.deps') as f:
+            data = json.load(f)
+        # JSON readers needn't keep the order commands were written in
+        shuffled = collections.OrderedDict(
+            (key, data.pop(key)) for key in ['.deps_format', 'commands'])
+        shuffled['commands'] = collections.OrderedDict(
+            reversed(sorted(shuffled['commands'].items())))
+        shuffled.update(data)
+        with open('.deps', 'w') as f:
+            json.dump(shuffled, f, separators=(',', ':'))
+        deps, meta = fabricate.CompactDepsFile('.deps').read()
+        assert meta['.deps_seen'] == seen
+
+def test_indexed_deps(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.touch('a', 'b')
+        builder = Builder(runner='always_runner', deps_format='indexed')
+        for i in range(50):
+            builder.done('cmd%d' % i, ['a'], [])
+        builder.write_deps()
+        assert fabricate.deps_file_format('.deps') == 'indexed'
+
+        builder = Builder(runner='always_runner', deps_format='indexed')
+        assert isinstance(builder.deps, fabricate.IndexedDeps)
+        assert builder.deps._changed == {}
+        assert not builder.cmdline_outofdate('cmd7')
+        assert builder.cmdline_outofdate('cmd50')
+        assert 'cmd9' in builder.deps
+        assert builder.deps._changed == {}    # lookups aren't rewritten
+        builder.done('cmd7', ['b'], [])
+        del builder.deps['cmd8']
+        assert len(builder.deps) == 49
+        builder.write_deps()
+        builder.deps.close()
+
+        builder = Builder(runner='always_runner', deps_format='indexed')
+        assert builder.deps['cmd7'] == {'b': 'input-' + EMPTY_FILE_MD5}
+        assert builder.deps['cmd9'] == {'a': 'input-' + EMPTY_FILE_MD5}
+        assert 'cmd8' not in builder.deps
+        assert sorted(builder.deps) == sorted('cmd%d' % i for i in range(50)
+                                              if i != 8)
+
+def test_journal_replayed_after_kill(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.touch('a', 'b')
+        builder = Builder(runner='always_runner', journal=True)
+        builder.done('cmd1', ['a'], [])
+        builder.write_deps()
+        builder.done('cmd2', ['b'], [])
+        # build killed here: .deps not saved, but cmd2 is in the journal
+        builder._journal_file.close()   # releases its lock, as if killed
+        assert os.path.exists('.deps.journal')
+        with open('.deps.journal', 'a') as f:
+            f.write('["cmd3", {"a": "inp')    # partly written entry
+
+        builder = Builder(runner='always_runner', journal=True)
+        assert sorted(builder.deps) == ['cmd1', 'cmd2']
+        assert not builder.cmdline_outofdate('cmd2')
+        builder.done('cmd3', ['a'], [])
+        running = Builder(runner='always_runner', journal=True)
+        assert sorted(running.deps) == ['cmd1']   # journal in use
+        running.done('cmd4', ['a'], [])
+        assert os.path.exists('.deps.journal.%d' % os.getpid())
+        builder._journal_file.close()
+        running._journal_file.close()
+        builder = Builder(runner='always_runner', journal=True)
+        assert sorted(builder.deps) == ['cmd1', 'cmd2', 'cmd3', 'cmd4']
+        builder.write_deps()
+        assert not os.path.exists('.deps.journal')
+        assert not os.path.exists('.deps.lock')
+        assert not os.path.exists('.deps.journal.%d' % os.getpid())
+        with open('.deps') as f:
+            assert sorted(json.load(f)) == ['.deps_build', '.deps_seen',
+                                          '.deps_version', 'cmd1', 'cmd2',
+                                          'cmd3', 'cmd4']
+
+@pytest.mark.parametrize("deps_format",
+                         ['json', 'compact', 'indexed', 'sqlite'])
+def test_runner_pickles_for_parallel_workers(builddir, no_atexit, deps_format):
+    with local.cwd(builddir):
+        sh.touch('a')
+        builder = Builder(runner='always_runner', deps_format=deps_format)
+        builder.done('cmd', ['a'], [])
+        builder.write_deps()
+        builder = Builder(runner='always_runner', deps_format=deps_format,
+                          shared_hash_cache='hashes.sqlite', hash_jobs=2)
+        assert sorted(builder.deps) == ['cmd']
+        assert builder._prehashing
+        builder.done('cmd', ['a'], [])
+        runner = pickle.loads(pickle.dumps(builder.runner))
+        assert runner._builder.dirs == builder.dirs
+        assert runner._builder._is_relevant('a')
+        assert not hasattr(runner._builder, 'hash_cache')
+        if builder._journal_file is not None:
+            builder._journal_file.close()
+
+
+@pytest.mark.parametrize("deps_format",
+                         ['json', 'compact', 'indexed', 'sqlite'])
+def test_gc(builddir, no_atexit, deps_format):
+    with local.cwd(builddir):
+        sh.touch('a')
+        builder = Builder(runner='always_runner', deps_format=deps_format)
+        for command in ['cmd1', 'cmd2', 'cmd3']:
+            sh.touch(command + '.out')
+            builder.cmdline_outofdate(command)
+            builder.done(command, ['a'], [command + '.out'])
+        builder.done('cmd4', ['a'], ['cmd3.out'])
+        builder.write_deps()
+
+        # second build only reaches cmd1 and cmd4
+        builder = Builder(runner='always_runner')
+        assert builder.cmdline_outofdate('cmd1') is False
+        builder.cmdline_outofdate('cmd4')
+        assert builder.gc(2) == []
+        builder.write_deps()
+        if deps_format == 'json':
+            with open('.deps') as f:
+                meta = json.load(f)
+            assert meta['.deps_build'] == 2
+            assert meta['.deps_seen'] == [2, 1, 1, 2]   # sorted commands
+
+        # third build: cmd2 and cmd3 were last seen two builds ago
+        builder = Builder(runner='always_runner')
+        builder.cmdline_outofdate('cmd1')
+        assert dict((command, builder._last_seen(command))
+                    for command in builder.deps) == {
+            'cmd1': 3, 'cmd2': 1, 'cmd3': 1, 'cmd4': 2}
+        assert sorted(builder.gc(2, remove_outputs=True)) == ['cmd2', 'cmd3']
+        assert sorted(builder.deps) == ['cmd1', 'cmd4']
+        assert not os.path.exists('cmd2.out')
+        assert os.path.exists('cmd3.out')   # still produced by cmd4
+        assert os.path.exists('cmd1.out')
+
+
+def test_targets(builddir, no_atexit, capfd):
+    with local.cwd(builddir):
+        sh.touch('a.c', 'b.c', 'a.o', 'b.o', 'prog')
+        builder = Builder(runner='always_runner')
+        builder.done('echo a', ['a.c'], ['a.o'])
+        builder.done('echo b', ['b.c'], ['b.o'])
+        builder.done('echo prog', ['a.o', 'b.o'], ['prog'])
+        builder.write_deps()
+
+        assert builder.producer('a.o') == 'echo a'
+        assert builder.producer(os.path.abspath('prog')) == 'echo prog'
+        assert builder.producer('a.c') is None
+        assert builder.consumers('a.o') == ['echo prog']
+        assert builder.needed_commands(['a.o']) == set(['echo a'])
+        assert builder.needed_commands(['prog']) == set([
+            'echo a', 'echo b', 'echo prog'])
+        with pytest.raises(fabricate.PathError):
+            builder.needed_commands(['a.c'])
+
+        with open('a.c', 'w') as f:
+            f.write('changed')
+        with open('b.c', 'w') as f:
+            f.write('changed')
+        builder = Builder(runner='always_runner', targets=['b.o'])
+        capfd.readouterr()
+        builder.run('echo', 'a')
+        assert capfd.readouterr().out == ''
+        builder.run('echo', 'b')
+        assert capfd.readouterr().out == 'echo b\nb\n'
+
+        # prog's command line changed, so it isn't recorded as its producer
+        builder = Builder(runner='always_runner', targets=['prog'])
+        builder.run('echo', 'prog', '-O')
+        assert capfd.readouterr().out == 'echo prog -O\nprog -O\n'
+
+        builder = Builder(runner='always_runner', targets=['missing'])
+        builder.run('echo', 'a')
+        out, err = capfd.readouterr()
+        assert out == 'echo a\na\n'
+        assert "producing 'missing', so building everything" in err
+        builder.run('echo', 'b')
+        assert capfd.readouterr().out == 'echo b\nb\n'
+
+
+def test_command_digests(builddir, no_atexit, capfd):
+    with local.cwd(builddir):
+        sh.touch('a')
+        builder = Builder(runner='always_runner', command_digests=True,
+                          debug=True)
+        key = builder._digest_key(['echo', 'a'], None)
+        assert key != builder._digest_key(['echo', 'a'], 'sub')
+        assert builder._digest_key(['echo', 'a'], os.path.abspath('sub')) == \
+            builder._digest_key(['echo', 'a'], 'sub/')
+        assert builder._digest_key(['echo', os.path.abspath('a')], None) != key
+        assert builder._digest_key(['echo', '/a'], None) != key
+        absolute = builder._digest_key(['echo', os.path.abspath('a')], None)
+        os.mkdir('moved')
+        with local.cwd('moved'):
+            assert builder._digest_key(['echo', os.path.abspath('a')],
+                                       None) == absolute
+        assert builder.run('echo', 'a') == ('echo a', None, None)
+        builder.done(key, ['a'], [])
+        builder.write_deps()
+        with open('.deps') as f:
+            saved = json.load(f)
+        assert sorted(saved) == ['.deps_build', '.deps_seen', '.deps_version',
+                                 key]
+        with open('.deps.commands') as f:
+            assert json.load(f) == {key: 'echo a'}
+        saved_inode = os.stat('.deps.commands').st_ino
+
+        builder = Builder(runner='always_runner', command_digests=True,
+                          debug=True)
+        capfd.readouterr()
+        builder.run('echo', 'a')
+        assert capfd.readouterr().out == ''
+        builder.write_deps()
+        # no command was added, so the command lines weren't saved again
+        assert os.stat('.deps.commands').st_ino == saved_inode
+        with open('a', 'w') as f:
+            f.write('changed')
+        builder = Builder(runner='always_runner', command_digests=True,
+                          debug=True)
+        builder.run('echo', 'a')
+        assert "rebuilding 'echo a', hash for input a" in capfd.readouterr().out
+
+def test_command_digests_rekeyed(builddir, no_atexit, capfd):
+    with local.cwd(builddir):
+        sh.touch('a', 'a.out')
+        builder = Builder(runner='always_runner')
+        builder.done('echo a', ['a'], ['a.out'])
+        builder.write_deps()
+
+        # turning command_digests on re-keys the entry without rerunning
+        builder = Builder(runner='always_runner', command_digests=True)
+        key = builder._digest_key(['echo', 'a'], None)
+        assert builder.producer('a.out') == 'echo a'
+        capfd.readouterr()
+        builder.run('echo', 'a')
+        assert capfd.readouterr().out == ''
+        assert sorted(builder.deps) == [key]
+        assert builder.producer('a.out') == key
+        assert builder.consumers('a') == [key]
+        builder.write_deps()
+
+        # and turning it off again re-keys it back
+        builder = Builder(runner='always_runner')
+        builder.run('echo', 'a')
+        assert capfd.readouterr().out == ''
+        assert sorted(builder.deps) == ['echo a']
+        builder.write_deps()
+        assert not os.path.exists('.deps.commands')
+
+def test_command_digests_off(builddir, no_atexit, monkeypatch):
+    with local.cwd(builddir):
+        def digest_key(*args):
+            raise AssertionError('digest computed')
+        monkeypatch.setattr(Builder, '_digest_key', digest_key)
+        builder = Builder(runner='always_runner')
+        builder.run('echo', 'a')
+        builder.write_deps()
+        assert not os.path.exists('.deps.commands')
+
+
+def test_migrate_v1(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.touch('a', 'b')
+        with open('.deps', 'w') as f:
+            json.dump({'.deps_version': 1,
+                       'cmd': {'a': EMPTY_FILE_MD5, 'b': EMPTY_FILE_MD5}}, f)
+        builder = Builder(runner='always_runner')
+        assert builder.deps == {'cmd': {'a': 'input-' + EMPTY_FILE_MD5,
+                                        'b': 'input-' + EMPTY_FILE_MD5}}
+        assert not builder.cmdline_outofdate('cmd')
+
+        with open('.deps', 'w') as f:
+            json.dump({'.deps_version': 99, 'cmd': {}}, f)
+        builder = Builder(runner='always_runner')
+        assert builder.deps == {}
+
+def test_rehash(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.touch('a', 'b')
+        builder = Builder(runner='always_runner')
+        builder.done('cmd1', ['a'], [])
+        builder.done('cmd2', ['a', 'b'], [])
+        builder.write_deps()
+        with open('b', 'w') as f:
+            f.write('changed')
+
+        builder = Builder(runner='always_runner', hasher='sha1')
+        assert builder.rehash() == 2
+        assert builder.deps['cmd1'] == {'a': 'input-' + sha1_hasher('a')}
+        assert builder.deps['cmd2'] == {'a': 'input-' + sha1_hasher('a'),
+                                        'b': 'input-' + EMPTY_FILE_MD5}
+        assert builder.rehash() == 0
+
+
+@pytest.mark.parametrize("deps_format", ['json', 'compact', 'indexed'])
+def test_concurrent_builds_merge(builddir, no_atexit, deps_format):
+    with local.cwd(builddir):
+        sh.touch('a', 'b', 'c')
+        builder = Builder(runner='always_runner', deps_format=deps_format)
+        builder.done('cmd1', ['a'], [])
+        builder.done('cmd2', ['a'], [])
+        builder.done('old', ['a'], [])
+        builder.write_deps()
+
+        first = Builder(runner='always_runner', deps_format=deps_format)
+        second = Builder(runner='always_runner', deps_format=deps_format)
+        first.done('cmd1', ['b'], [])
+        first.done('cmd3', ['a'], [])
+        second.cmdline_outofdate('cmd1')
+        second.done('cmd2', ['c'], [])
+        assert second.gc(1) == ['old']
+        first.write_deps()
+        second.write_deps()
+
+        builder = Builder(runner='always_runner')
+        assert dict(builder.deps.items()) == {
+            'cmd1': {'b': 'input-' + EMPTY_FILE_MD5},
+            'cmd2': {'c': 'input-' + EMPTY_FILE_MD5},
+            'cmd3': {'a': 'input-' + EMPTY_FILE_MD5}}
+
+
+def test_changed_set(builddir, no_atexit, mocker):
+    with local.cwd(builddir):
+        sh.touch('h', 'a.c', 'b.c', 'c.c', 'a.o', 'prog')
+        builder = Builder(runner='always_runner')
+        builder.done('cc a', ['a.c', 'h'], ['a.o'])
+        builder.done('cc b', ['b.c', 'h'], [])
+        builder.done('cc c', ['c.c'], [])
+        builder.done('link', ['a.o'], ['prog'])
+        builder.write_deps()
+        with open('h', 'w') as f:
+            f.write('changed')
+
+        hasher = mocker.Mock(side_effect=md5_hasher)
+        builder = Builder(runner='always_runner', changed_set=True,
+                          hasher=hasher)
+        assert builder.cmdline_outofdate('cc a')
+        assert sorted(builder._dirty) == ['cc a', 'cc b']
+        assert hasher.call_count == 6     # every path hashed once
+        assert builder.cmdline_outofdate('cc b')
+        assert not builder.cmdline_outofdate('cc c')
+        assert hasher.call_count == 6
+
+        with open('a.o', 'w') as f:
+            f.write('rebuilt')
+        builder.done('cc a', ['a.c', 'h'], ['a.o'])
+        assert builder.cmdline_outofdate('link')
+
+
+def test_dep_sets(builddir, no_atexit, mocker):
+    with local.cwd(builddir):
+        headers = ['h%d' % i for i in range(fabricate.dep_set_min_size)]
+        sh.touch('a.c', 'b.c', 'c.c', *headers)
+        builder = Builder(runner='always_runner', dep_sets=True)
+        for source in ['a.c', 'b.c']:
+            builder.done('cc ' + source, [source] + headers, [])
+        builder.done('cc c.c', ['c.c'] + headers[1:], [])
+        assert builder.deps['cc a.c'] == {'a.c': 'input-' + EMPTY_FILE_MD5}
+        builder.write_deps()
+        with open('.deps') as f:
+            saved = json.load(f)
+        assert len(saved['.deps_sets']) == 1
+        assert sorted(saved['.deps_command_sets']) == sorted(
+            fabricate._set_key(command) for command in ['cc a.c', 'cc b.c'])
+        assert 'cc a.c' not in json.dumps(saved['.deps_command_sets'])
+
+        hasher = mocker.Mock(side_effect=md5_hasher)
+        builder = Builder(runner='always_runner', hasher=hasher)
+        assert not builder.cmdline_outofdate('cc a.c')
+        assert not builder.cmdline_outofdate('cc b.c')
+        assert hasher.call_count == len(headers) + 2
+        assert builder.producer('h0') is None
+        assert builder.consumers('h0') == ['cc a.c', 'cc b.c']
+
+        with open('h0', 'w') as f:
+            f.write('changed')
+        builder = Builder(runner='always_runner')
+        assert builder.cmdline_outofdate('cc a.c')
+        assert builder.cmdline_outofdate('cc b.c')
+        assert not builder.cmdline_outofdate('cc c.c')
+        builder.done('cc a.c', ['a.c'], [])   # no longer uses the headers
+        builder.write_deps()
+        with open('.deps') as f:
+            saved = json.load(f)
+        assert saved['.deps_command_sets'] == {
+            fabricate._set_key('cc b.c'): list(saved['.deps_sets'])[0]}
+
+def test_dep_sets_rekeyed(builddir, no_atexit, capfd):
+    with local.cwd(builddir):
+        headers = ['h%d' % i for i in range(fabricate.dep_set_min_size)]
+        sh.touch('a.c', 'b.c', *headers)
+        builder = Builder(runner='always_runner', dep_sets=True)
+        builder.done('cc a.c', ['a.c'] + headers, [])
+        builder.done('cc b.c', ['b.c'] + headers, [])
+        builder.write_deps()
+        with open('.deps') as f:
+            saved = json.load(f)
+        # files from before dep sets were keyed by digest
+        set_id, = saved['.deps_sets']
+        saved['.deps_command_sets'] = {'cc a.c': set_id, 'cc b.c': set_id}
+        with open('.deps', 'w') as f:
+            json.dump(saved, f)
+
+        # the set's hashes are re-keyed along with the entries' hashes
+        builder = Builder(runner='always_runner', hasher='sha1', dep_sets=True)
+        assert builder.rehash() == 2
+        dep_set, = builder._sets.values()
+        assert dep_set['h0'] == 'input-' + sha1_hasher('h0')
+        assert builder.deps['cc a.c'] == {'a.c': 'input-' + sha1_hasher('a.c')}
+        for command in ['cc a.c', 'cc b.c']:
+            assert builder._full_deps(command, builder.deps[command])['h0'] \
+                == dep_set['h0']
+        builder.write_deps()
+
+        # and turning command_digests on moves the command's set
+        builder = Builder(runner='always_runner', hasher='sha1',
+                          command_digests=True, debug=True)
+        capfd.readouterr()
+        builder.run('cc', 'a.c')
+        assert 'rebuilding' not in capfd.readouterr().out
+        key = builder._digest_key(['cc', 'a.c'], None)
+        assert sorted(builder._command_sets) == sorted(
+            [key, fabricate._set_key('cc b.c')])
+        builder.write_deps()
+        with open('h0', 'w') as f:
+            f.write('changed')
+        builder = Builder(runner='always_runner', hasher='sha1',
+                          command_digests=True)
+        assert builder.cmdline_outofdate(key)
+
+def test_dep_sets_not_made_with_sqlite(builddir, no_atexit):
+    with local.cwd(builddir):
+        headers = ['h%d' % i for i in range(fabricate.dep_set_min_size)]
+        sh.touch('a.c', *headers)
+        builder = Builder(runner='always_runner', depsname='deps.db',
+                          dep_sets=True)
+        builder.done('cc a.c', ['a.c'] + headers, [])
+        # build killed here, before the metadata was saved
+        assert builder._command_sets == {}
+
+        with open('h0', 'w') as f:
+            f.write('changed')
+        builder = Builder(runner='always_runner', depsname='deps.db',
+                          dep_sets=True)
+        assert builder.cmdline_outofdate('cc a.c')
@@ -6,11 +6,14 @@ import pytest
 import plumbum.cmd as sh
 from plumbum import local
 import os
+import json
+import threading
 from copy import copy
 
 
 from fabricate import *
 from fabricate import md5func
+import fabricate
 from conftest import *
 
 EMPTY_FILE_MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
@@ -31,3 +34,422 @@ def test_md5_hasher(builddir):
         assert md5_hasher('testlink_nofile') == md5func('nofile'.encode('utf-8')).hexdigest()
 
 
+
+def test_mtime_hasher(builddir):
+    with local.cwd(builddir):
+        sh.touch('testfile')
+        assert mtime_hasher('nofile') == None
+        assert mtime_hasher('testfile') == 'mtime:%d' % os.stat('testfile').st_mtime_ns
+
+def test_stat_cache(builddir, no_atexit, monkeypatch):
+    monkeypatch.setattr(fabricate, 'stat_racy_time', -1)
+    hashed = []
+    def counting_hasher(filename):
+        hashed.append(filename)
+        return md5_hasher(filename)
+
+    with local.cwd(builddir):
+        with open('testfile', 'w') as f:
+            f.write('old')
+        builder = Builder(runner='always_runner', hasher=counting_hasher,
+                          stat_cache=True)
+        builder.done('cmd', ['testfile'], [])
+        builder.write_deps()
+        assert hashed == ['testfile']
+
+        builder = Builder(runner='always_runner', hasher=counting_hasher,
+                          stat_cache=True)
+        assert not builder.cmdline_outofdate('cmd')
+        assert hashed == ['testfile']   # fingerprint unchanged, not re-hashed
+
+        with open('testfile', 'w') as f:
+            f.write('new')
+        builder = Builder(runner='always_runner', hasher=counting_hasher,
+                          stat_cache=True)
+        assert builder.cmdline_outofdate('cmd')
+        assert hashed == ['testfile', 'testfile']
+
+def test_prehash(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.touch('a', 'b')
+        builder = Builder(runner='always_runner')
+        builder.done('cmd', ['a', 'b'], [])
+        builder.write_deps()
+
+        builder = Builder(runner='always_runner', hash_jobs=2)
+        assert sorted(builder.deps) == ['cmd']
+        assert sorted(builder._prehashing) == ['a', 'b']
+        assert not builder.cmdline_outofdate('cmd')
+        assert builder._prehashing == {}
+        assert builder.hash_cache == {'a': EMPTY_FILE_MD5, 'b': EMPTY_FILE_MD5}
+
+def test_prehash_stopped_before_saving(builddir, no_atexit):
+    with local.cwd(builddir):
+        paths = ['f%d' % i for i in range(20)]
+        sh.touch(*paths)
+        builder = Builder(runner='always_runner', stat_cache=True)
+        builder.done('cmd', paths, [])
+        builder.write_deps()
+
+        hashing = threading.Event()
+        release = threading.Event()
+        def slow_hasher(filename):
+            hashing.set()
+            release.wait()
+            return md5_hasher(filename)
+        builder = Builder(runner='always_runner', stat_cache=True,
+                          hash_jobs=1, hasher=slow_hasher)
+        assert sorted(builder.deps) == ['cmd']
+        hashing.wait()
+        threading.Timer(0.1, release.set).start()
+        builder.write_deps()    # cancels the queue, waits for the file hashing
+        assert builder._prehash_pool is None
+        assert len(builder._prehashing) == 1
+        assert all(future.done() for future in builder._prehashing.values())
+        assert not builder.cmdline_outofdate('cmd')
+
+def test_md5_hasher_chunked(builddir, monkeypatch):
+    import hashlib
+    monkeypatch.delattr(hashlib, 'file_digest', raising=False)
+    monkeypatch.setattr(fabricate, 'hash_buffer_size', 7)
+    data = b'0123456789' * 100 + b'tail'
+    with local.cwd(builddir):
+        with open('testfile', 'wb') as f:
+            f.write(data)
+        assert md5_hasher('testfile') == md5func(data).hexdigest()
+
+def test_named_hashers(builddir):
+    with local.cwd(builddir):
+        sh.touch('testfile')
+        assert hashers['sha1']('testfile') == \
+            'sha1:da39a3ee5e6b4b0d3255bfef95601890afd80709'
+        assert hashers['blake2b']('testfile') == \
+            'blake2b:cae66941d9efbd404e4d88758ea67670'
+        assert hashers['blake2b']('nofile') == None
+        assert hashers['stat']('testfile').startswith('stat:0-')
+        assert fabricate.hash_algorithm(EMPTY_FILE_MD5) == 'md5'
+        assert fabricate.hash_algorithm(blake2b_hasher('testfile')) == 'blake2b'
+        assert fabricate.hash_algorithm('custom') == None
+
+def test_hasher_switch_rehashes(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.touch('a', 'b')
+        builder = Builder(runner='always_runner', hasher='md5')
+        builder.done('cmd', ['a', 'b'], [])
+        builder.write_deps()
+
+        builder = Builder(runner='always_runner', hasher='blake2b')
+        assert not builder.cmdline_outofdate('cmd')
+        assert builder.deps['cmd'] == {
+            'a': 'input-' + blake2b_hasher('a'),
+            'b': 'input-' + blake2b_hasher('b')}
+
+        with open('a', 'w') as f:
+            f.write('changed')
+        builder = Builder(runner='always_runner', hasher='sha1')
+        builder._deps = {'cmd': {'a': 'input-' + EMPTY_FILE_MD5}}
+        assert builder.cmdline_outofdate('cmd')
+
+def test_tree_hasher(builddir, monkeypatch):
+    monkeypatch.setattr(fabricate, 'tree_hash_threshold', 10)
+    monkeypatch.setattr(fabricate, 'tree_hash_chunk_size', 4)
+    with local.cwd(builddir):
+        with open('small', 'wb') as f:
+            f.write(b'123456789')
+        with open('large', 'wb') as f:
+            f.write(b'0123456789')
+        assert tree_hasher('small') == md5_hasher('small')
+        root = md5func(b''.join(md5func(chunk).digest()
+                                for chunk in [b'0123', b'4567', b'89']))
+        assert tree_hasher('large') == 'md5tree:' + root.hexdigest()
+        assert fabricate.hash_algorithm(tree_hasher('large')) == 'md5tree'
+
+@pytest.mark.parametrize("dir_hashing", ['listing', 'contents'])
+def test_dir_hashing(builddir, no_atexit, dir_hashing):
+    with local.cwd(builddir):
+        sh.mkdir('-p', 'testdir/sub')
+        sh.touch('testdir/a', 'testdir/sub/b')
+        builder = Builder(runner='always_runner', dir_hashing=dir_hashing)
+        builder.done('ls', ['testdir'], [])
+        assert builder.deps['ls']['testdir'].startswith('input-dir:')
+        builder.write_deps()
+
+        builder = Builder(runner='always_runner', dir_hashing=dir_hashing)
+        assert not builder.cmdline_outofdate('ls')
+
+        with open('testdir/sub/b', 'w') as f:
+            f.write('changed')
+        builder = Builder(runner='always_runner', dir_hashing=dir_hashing)
+        assert builder.cmdline_outofdate('ls') == (dir_hashing == 'contents')
+
+        sh.touch('testdir/c')
+        builder = Builder(runner='always_runner', dir_hashing=dir_hashing)
+        assert builder.cmdline_outofdate('ls')
+
+def test_dir_hashing_output_in_input_dir(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.mkdir('testdir')
+        builder = Builder(runner='always_runner', dir_hashing='listing')
+        builder.done('ls', ['testdir'], [])
+        assert not builder.cmdline_outofdate('ls')
+        # rerun, creating a file in the directory it reads
+        sh.touch('testdir/x')
+        builder.done('ls', ['testdir'], ['testdir/x'])
+        builder.write_deps()
+
+        builder = Builder(runner='always_runner', dir_hashing='listing')
+        assert not builder.cmdline_outofdate('ls')
+
+def test_dir_hashing_rehashes_name_hash(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.mkdir('testdir')
+        builder = Builder(runner='always_runner')
+        builder.done('ls', ['testdir'], [])
+        builder.write_deps()
+
+        builder = Builder(runner='always_runner', dir_hashing='listing')
+        assert not builder.cmdline_outofdate('ls')
+        assert builder.deps['ls']['testdir'].startswith('input-dir:')
+
+def test_shared_hash_cache(builddir, no_atexit, monkeypatch):
+    monkeypatch.setattr(fabricate, 'stat_racy_time', -1)
+    with local.cwd(builddir):
+        sh.touch('testfile')
+        cache = os.path.abspath('hashes.sqlite')
+        builder = Builder(runner='always_runner', shared_hash_cache=cache)
+        builder.done('cmd', ['testfile'], [])
+        builder.write_deps()
+
+        # a fresh build directory finds the hash in the shared cache
+        os.remove('.deps')
+        monkeypatch.setitem(fabricate.hashers, 'md5', lambda f: 1/0)
+        hasher = fabricate.hashers['md5']
+        builder = Builder(runner='always_runner', hasher=hasher,
+                          shared_hash_cache=HashCache(cache))
+        builder.done('cmd', ['testfile'], [])
+        assert builder.deps['cmd'] == {'testfile': 'input-' + EMPTY_FILE_MD5}
+
+def test_immutable_dirs(builddir, no_atexit):
+    with local.cwd(builddir):
+        sh.mkdir('toolchain')
+        sh.touch('toolchain/gcc', 'source.c')
+        builder = Builder(runner='always_runner', immutable_dirs=['toolchain'])
+        builder.done('gcc', ['toolchain/gcc', 'source.c'], [])
+        assert builder.deps['gcc'] == {
+            'toolchain/gcc': 'input-' + stat_hasher('toolchain/gcc'),
+            'source.c': 'input-' + EMPTY_FILE_MD5}
+
+def test_git_hasher(builddir, monkeypatch):
+    monkeypatch.setattr(fabricate, 'stat_racy_time', -1)
+    with local.cwd(builddir):
+        sh.git('init', '-q', '.')
+        with open('clean', 'w') as f:
+            f.write('clean\n')
+        with open('dirty', 'w') as f:
+            f.write('dirty\n')
+        sh.git('add', 'clean', 'dirty')
+        with open('dirty', 'w') as f:
+            f.write('changed\n')
+        sh.touch('untracked')
+
+        hasher = GitHasher()
+        for name in ['clean', 'dirty', 'untracked']:
+            blob = sh.git('hash-object', name).strip()
+            assert git_blob_hasher(name) == 'git:' + blob
+            assert hasher(name) == 'git:' + blob
+        assert sorted(hasher._blobs) == ['clean']
+        assert hasher('nofile') == None
+
+def test_strace_probe_cached(builddir, monkeypatch, mocker):
+    with local.cwd(builddir):
+        sh.touch('strace')
+        strace = os.path.abspath('strace')
+        monkeypatch.setenv('XDG_CACHE_HOME', os.path.abspath('cache'))
+        monkeypatch.setattr(fabricate.platform, 'system', lambda: 'Linux')
+        monkeypatch.setattr(fabricate.shutil, 'which', lambda name: strace)
+        monkeypatch.setattr(StraceRunner, '_probed_system_calls', {})
+        def fake_strace(args, **kwargs):
+            proc = mocker.Mock()
+            trace = [arg for arg in args if arg.startswith('trace=')][0]
+            calls = trace.split('=')[1].split(',')
+            invalid = [call for call in calls if call.endswith('stat64')]
+            if invalid:
+                proc.returncode = 1
+                proc.communicate.return_value = (
+                    b'', b"strace: invalid system call '%s'\n"
+                    % invalid[0].encode())
+            else:
+                proc.returncode = 0
+                proc.communicate.return_value = (b'strace -- version 6.1\n', b'')
+            return proc
+        popen = mocker.patch('subprocess.Popen', side_effect=fake_strace)
+
+        expected = ','.join(call for call in StraceRunner.possible_system_calls
+                            if call not in ('stat64', 'lstat64'))
+        assert StraceRunner.get_strace_system_calls() == expected
+        assert popen.call_count == 4
+        assert StraceRunner.get_strace_options() == ['--seccomp-bpf']
+        assert StraceRunner.get_strace_system_calls() == expected
+        assert popen.call_count == 4
+
+        # a new process reads the probe from the cache
+        monkeypatch.setattr(StraceRunner, '_probed_system_calls', {})
+        assert StraceRunner.get_strace_system_calls() == expected
+        assert popen.call_count == 4
+        with open(os.path.join('cache', 'fabricate', 'strace.json')) as f:
+            entry = list(json.load(f).values())[0]
+        assert entry['version'] == 'strace -- version 6.1'
+        assert entry['options'] == ['--seccomp-bpf']
+
+        # a changed strace binary is probed again
+        monkeypatch.setattr(StraceRunner, '_probed_system_calls', {})
+        with open('strace', 'w') as f:
+            f.write('new strace')
+        assert StraceRunner.get_strace_system_calls() == expected
+        assert popen.call_count == 8
+
+def test_strace_parser(builddir, no_atexit, monkeypatch):
+    monkeypatch.setattr(StraceRunner, 'get_strace_system_calls',
+                        staticmethod(lambda: 'open'))
+    with local.cwd(builddir):
+        runner = StraceRunner(Builder(runner='always_runner'))
+        trace = b'''\
+100 execve("/bin/sh", ["sh"], 0x7ffc /* 1 vars */) = 0
+100 newfstatat(AT_FDCWD, "in1", {st_mode=S_IFREG|0644, st_size=0, ...}, 0) = 0
+100 newfstatat(3, "", {st_mode=S_IFREG|0644, ...}, AT_EMPTY_PATH) = 0
+100 clone3({flags=CLONE_VM|CLONE_VFORK, exit_signal=SIGCHLD, stack=0x7f, stack_size=0x9000}, 88 <unfinished ...>
+101 openat(AT_FDCWD, "out1", O_WRONLY|O_CREAT|O_TRUNC, 0666) = 3
+100 <... clone3 resumed>) = 101
+100 chdir("sub") = 0
+100 statx(AT_FDCWD, "in2", AT_STATX_SYNC_AS_STAT, STATX_ALL, {stx_mask=STATX_ALL, ...}) = 0
+100 openat2(AT_FDCWD, "out2", {flags=O_RDWR|O_CREAT, mode=0644, resolve=0}, 24) = 3
+100 openat(AT_FDCWD, "in \\"3\\"", O_RDONLY|O_CLOEXEC) = 3
+100 renameat2(AT_FDCWD, "tmp", AT_FDCWD, "out3", RENAME_NOREPLACE) = 0
+100 mkdir("in4", 0777) = -1 EEXIST (File exists)
+100 mkdirat(AT_FDCWD, "out4", 0777) = 0
+100 symlink("target", "out5") = 0
+101 +++ exited with 0 +++
+100 exit_group(2) = ?
+100 +++ exited with 2 +++
+'''
+        runner.status = 0
+        processes = {}
+        unfinished = {}
+        for line in trace.splitlines(True):
+            runner._match_line(line, processes, unfinished)
+        assert runner.status == 2
+        assert processes[b'101'].outputs == set(['out1'])
+        assert processes[b'100'].outputs == set([
+            'sub/out2', 'sub/out3', 'sub/out4', 'sub/out5'])
+        assert processes[b'100'].deps == set([
+            'in1', 'sub/in2', 'sub/in "3"', 'sub/in4'])
+
+        runner._match_line(b'102 exit_group(-1) = ?\n', processes, unfinished)
+        assert runner.status == -1
+
+        # paths relative to a directory fd other than AT_FDCWD are skipped
+        absolute = os.path.abspath('in6').encode()
+        for line in [b'101 openat(3, "in5", O_RDONLY) = 4\n',
+                     b'101 openat(3, "%s", O_RDONLY) = 4\n' % absolute,
+                     b'101 newfstatat(4, "in7", {st_mode=S_IFREG}, 0) = 0\n',
+                     b'101 mkdirat(3, "out6", 0777) = 0\n',
+                     b'101 renameat(AT_FDCWD, "tmp", 3, "out7") = 0\n',
+                     b'101 symlinkat("target", 3, "out8") = 0\n',
+                     b'101 symlinkat("target", AT_FDCWD, "out9") = 0\n']:
+            runner._match_line(line, processes, unfinished)
+        assert processes[b'101'].deps == set(['in6'])
+        assert processes[b'101'].outputs == set(['out1', 'out9'])
+
+def test_strace_runner_fifo(builddir, no_atexit, monkeypatch):
+    monkeypatch.setattr(StraceRunner, 'get_strace_system_calls',
+                        staticmethod(lambda: 'open'))
+    monkeypatch.setattr(StraceRunner, 'get_strace_options',
+                        staticmethod(lambda: []))
+    monkeypatch.setattr(StraceRunner, 'keep_temps', True)
+    trace = b'''\
+100 execve("/bin/true", ["true"], 0x7ffc /* 1 vars */) = 0
+100 openat(AT_FDCWD, "in", O_RDONLY) = 3
+100 openat(AT_FDCWD, "out", O_WRONLY|O_CREAT|O_TRUNC, 0666) = 3
+100 openat(AT_FDCWD, "gone", O_WRONLY|O_CREAT|O_TRUNC, 0666) = 3
+100 exit_group(0) = ?
+'''
+    fifos = []
+    def fake_shell(*args, **kwargs):
+        # stands in for strace, writing its trace to the fifo
+        fifos.append(args[2])
+        with open(args[2], 'wb') as f:
+            f.write(trace)
+    with local.cwd(builddir):
+        sh.touch('in', 'out')
+        monkeypatch.setattr(fabricate, 'shell', fake_shell)
+        runner = StraceRunner(Builder(runner='always_runner'))
+        assert runner('true') == (['in'], ['out'])
+        with open('strace000.txt', 'rb') as f:
+            assert f.read() == trace
+        assert not os.path.exists(os.path.dirname(fifos[0]))
+
+        # strace's status is ignored once it has traced the command
+        def failed_command(*args, **kwargs):
+            fake_shell(*args, **kwargs)
+            raise ExecutionError('', '', 1)
+        monkeypatch.setattr(fabricate, 'shell', failed_command)
+        assert runner('true') == (['in'], ['out'])
+
+        # but it is an error if strace wrote nothing
+        def failed_strace(*args, **kwargs):
+            raise ExecutionError('strace failed', '', 1)
+        monkeypatch.setattr(fabricate, 'shell', failed_strace)
+        with pytest.raises(ExecutionError):
+            runner('true')
+        assert os.path.exists('strace002.txt')
+
+        # a failure writing the log is raised once strace has finished
+        class FullDisk(object):
+            def write(self, line):
+                raise IOError(28, 'No space left on device')
+        monkeypatch.setattr(fabricate, 'shell', fake_shell)
+        os.mkfifo('fifo')
+        with pytest.raises(IOError):
+            runner._do_strace(['true'], {}, 'fifo', FullDisk())
+
+def test_strace_path_names_memo(builddir, no_atexit, monkeypatch, mocker):
+    monkeypatch.setattr(StraceRunner, 'get_strace_system_calls',
+                        staticmethod(lambda: 'open'))
+    monkeypatch.setattr(StraceRunner, 'get_strace_options',
+                        staticmethod(lambda: []))
+    trace = b'''\
+100 execve("/bin/true", ["true"], 0x7ffc /* 1 vars */) = 0
+100 openat(AT_FDCWD, "in", O_RDONLY) = 3
+100 stat("in", {st_mode=S_IFREG|0644, st_size=0, ...}) = 0
+100 openat(AT_FDCWD, "sub/in", O_RDONLY) = 3
+100 exit_group(0) = ?
+'''
+    def fake_shell(*args, **kwargs):
+        with open(args[2], 'wb') as f:
+            f.write(trace)
+    with local.cwd(builddir):
+        sh.mkdir('sub')
+        sh.touch('in', 'sub/in')
+        monkeypatch.setattr(fabricate, 'shell', fake_shell)
+        builder = Builder(runner='always_runner')
+        runner = StraceRunner(builder)
+        relevant_name = mocker.spy(runner, '_relevant_name')
+        processes = {}
+        for line in trace.splitlines(True) * 2:
+            runner._match_line(line, processes, {})
+        assert processes[b'100'].deps == set(['in', 'sub/in'])
+        assert relevant_name.call_count == 3    # once per distinct path
+
+        # path names are worked out again when the settings change
+        assert sorted(runner('true')[0]) == ['in', 'sub/in']
+        builder.dirs = ['sub']
+        assert runner('true')[0] == ['sub/in']
+        builder.dirs = ['.']
+        builder.ignoreprefix = 's'
+        assert runner('true')[0] == ['in']
+        builder.dirs = ['sub']
+        builder.ignoreprefix = '.'
+        with local.cwd('sub'):
+            assert runner('true')[0] == []
+        assert builder._is_relevant('sub/in')
+        assert not builder._is_relevant('in')
@@ -103,7 +103,9 @@ def test_mkdir(builddir, runner):
         },
         "touch testdir/f2": {
             "testdir/f2": "output-d41d8cd98f00b204e9800998ecf8427e"
-        }
+        },
+        ".deps_build": 1,
+        ".deps_seen": [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
     }
 
     # assertions
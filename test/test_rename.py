@@ -38,7 +38,9 @@ def test_rename(builddir, runner):
         "mv originalfile testfile": {
             "originalfile": "input-d41d8cd98f00b204e9800998ecf8427e",
             "testfile": "output-d41d8cd98f00b204e9800998ecf8427e"
-        }
+        },
+        ".deps_build": 1,
+        ".deps_seen": [1]
     }
 
     # assertions
@@ -58,7 +60,9 @@ def test_rename(builddir, runner):
         "mv originalfile testfile": {
             "originalfile": "input-321060ae067e2a25091be3372719e053",
             "testfile": "output-321060ae067e2a25091be3372719e053"
-        }
+        },
+        ".deps_build": 2,
+        ".deps_seen": [2]
     }
 
     with local.cwd(builddir):
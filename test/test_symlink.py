@@ -37,7 +37,9 @@ def test_symlink(builddir, runner):
         },
         "ln -s testfile testlink": {
             "testlink": "output-"
-        }
+        },
+        ".deps_build": 1,
+        ".deps_seen": [1, 1, 1]
     }
 
     # assertions